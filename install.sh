@@ -9,6 +9,7 @@ declare -A packages=(
 	["daemonizer"]="Daemonizer"
 	["discord_bot"]="Discord Bot"
 	["local_utilities"]="Local Utilities"
+	["streamwatch"]="StreamWatch"
 )
 
 # Parse user args
@@ -0,0 +1,43 @@
+"""
+Backoff
+
+How long to wait between attempts to reconnect (or restart) something. The
+wait doubles after each failed attempt, up to a maximum, and has some jitter
+so that several cameras on the same network don't retry in lockstep.
+"""
+
+import random
+
+# Seconds
+MIN_BACKOFF = 1
+MAX_BACKOFF = 60
+
+
+class Backoff():
+    """
+    Usage:
+        backoff = Backoff()
+        while not connect():
+            time.sleep(backoff.next())
+        backoff.reset()
+    """
+
+    def __init__(self, minimum: float = MIN_BACKOFF, maximum: float = MAX_BACKOFF):
+        self.minimum = minimum
+        self.maximum = maximum
+        self.delay = minimum
+
+    def next(self) -> float:
+        """
+        Return how long to wait before the next attempt (about "delay"
+        seconds), and double the delay for the attempt after that.
+        """
+        wait = self.delay * random.uniform(0.5, 1.5)
+        self.delay = min(self.delay * 2, self.maximum)
+        return wait
+
+    def reset(self) -> None:
+        """
+        Go back to the shortest wait, after a successful attempt.
+        """
+        self.delay = self.minimum
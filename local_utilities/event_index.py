@@ -0,0 +1,184 @@
+"""
+Event Index
+
+Keeps a record of every motion event in a SQLite database, so footage can be
+found without scrubbing through hours of video. Each event has the camera,
+when it started and stopped, the biggest box of motion seen, and where it is
+in the recordings (the file, and the frame offsets within it).
+
+Events are written in batches, by a background thread, so the stream is
+never held up by the database. The database uses WAL mode, so several
+cameras can write to it while it's being queried.
+"""
+
+import os
+import time
+import queue
+import sqlite3
+import logging
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY,
+    camera TEXT NOT NULL,
+    start_time REAL NOT NULL,
+    end_time REAL NOT NULL,
+    box_x INTEGER,
+    box_y INTEGER,
+    box_w INTEGER,
+    box_h INTEGER,
+    peak_area INTEGER,
+    video_file TEXT,
+    video_fps REAL,
+    start_frame INTEGER,
+    end_frame INTEGER
+);
+CREATE INDEX IF NOT EXISTS events_by_time ON events (start_time);
+CREATE INDEX IF NOT EXISTS events_by_camera ON events (camera, start_time);
+"""
+
+COLUMNS = (
+    "camera", "start_time", "end_time", "box_x", "box_y", "box_w", "box_h",
+    "peak_area", "video_file", "video_fps", "start_frame", "end_frame",
+)
+
+
+def connect(path: str, check_same_thread: bool = True) -> sqlite3.Connection:
+    connection = sqlite3.connect(path, timeout=30, check_same_thread=check_same_thread)
+    connection.row_factory = sqlite3.Row
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.executescript(SCHEMA)
+    return connection
+
+
+class MotionEvent():
+    """
+    A single motion event, from "New motion detected" to "Motion has stopped".
+
+    The video position is filled in by the video writer's thread (see
+    `BackgroundVideoWriter.mark`), once the frames have actually been written.
+    """
+
+    def __init__(self, camera: str, box: tuple, video_fps: float = None):
+        self.camera = camera
+        self.start_time = time.time()
+        self.end_time = None
+        self.box = box
+        self.peak_area = box[2] * box[3]
+        self.video_file = None
+        self.video_fps = video_fps
+        self.start_frame = None
+        self.end_frame = None
+
+    def update(self, box: tuple) -> None:
+        area = box[2] * box[3]
+        if area > self.peak_area:
+            self.peak_area = area
+            self.box = box
+
+    def set_start(self, filename: str, frame: int) -> None:
+        self.video_file = filename
+        self.start_frame = frame
+
+    def set_end(self, filename: str, frame: int) -> None:
+        # If it ran into the next segment, it goes to the end of the first one
+        if filename is not None and filename == self.video_file:
+            self.end_frame = frame
+
+    def row(self) -> tuple:
+        return (
+            self.camera, self.start_time, self.end_time, *self.box,
+            self.peak_area, self.video_file, self.video_fps, self.start_frame, self.end_frame,
+        )
+
+
+class EventIndex():
+    def __init__(self, path: str, batch_size: int = 50, flush_seconds: float = 5):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_seconds = flush_seconds
+
+        # Opened here, so that a bad path fails straight away, rather than
+        # killing the thread. Only the thread uses it after this.
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._connection = connect(path, check_same_thread=False)
+
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="event-index", daemon=True)
+        self._thread.start()
+
+        # Metrics
+        self.events_written = 0
+        self.batches_written = 0
+
+    def record(self, event: MotionEvent) -> None:
+        """
+        Queue a finished event to be written. Safe to call from any thread.
+        """
+        self._queue.put(event)
+
+    def close(self) -> None:
+        """
+        Write everything that's queued, and stop the thread.
+        """
+        self._queue.put(None)
+        self._thread.join()
+
+    def _run(self) -> None:
+        try:
+            self._write_batches()
+        except Exception:
+            # Otherwise every event after this is lost without a word
+            logging.exception(f"Motion event writer failed. No more events will be written to '{self.path}'.")
+        finally:
+            self._connection.close()
+
+    def _write_batches(self) -> None:
+        stopping = False
+        while not stopping:
+            batch = []
+            deadline = time.monotonic() + self.flush_seconds
+            while len(batch) < self.batch_size:
+                try:
+                    event = self._queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                if event is None:
+                    stopping = True
+                    break
+                batch.append(event.row())
+
+            if batch:
+                self._write(batch)
+
+    def _write(self, rows: list) -> None:
+        placeholders = ", ".join("?" * len(COLUMNS))
+        try:
+            with self._connection:
+                self._connection.executemany(f"INSERT INTO events ({', '.join(COLUMNS)}) VALUES ({placeholders})", rows)
+            self.events_written += len(rows)
+            self.batches_written += 1
+        except sqlite3.Error as e:
+            logging.warning(f"Failed to write {len(rows)} motion events to '{self.path}': {e}")
+
+
+def find_events(connection: sqlite3.Connection, since: float = None, until: float = None, camera: str = None) -> list:
+    """
+    Find the events that overlap a time range (in seconds since the epoch).
+    """
+    conditions, params = [], []
+    if since is not None:
+        conditions.append("end_time >= ?")
+        params.append(since)
+    if until is not None:
+        conditions.append("start_time <= ?")
+        params.append(until)
+    if camera is not None:
+        conditions.append("camera = ?")
+        params.append(camera)
+
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    return connection.execute(f"SELECT * FROM events {where} ORDER BY start_time", params).fetchall()
@@ -0,0 +1,148 @@
+"""
+FFmpeg Capture
+
+An alternative to `cv2.VideoCapture`, which runs a local ffmpeg process and
+reads raw BGR frames from its stdout.
+
+Because ffmpeg does the decoding, it can also do the cheap work at the same
+time: scaling frames down, dropping the frame rate, or only decoding
+keyframes. Frames are read straight into a pool of reusable buffers (with
+`readinto`), so nothing is allocated per frame.
+
+Frames are handed on to queues, rings and the pre-roll (sometimes only as
+views), so a buffer is only reused once every array using it has gone. Each
+frame is a view of a flat array over its buffer, and numpy makes every view of
+that frame (e.g: a crop) refer to the flat array too, so a weak reference to
+it says when the buffer is free. If every buffer is still in use, the pool
+grows, so it settles at however many frames are in flight at once.
+"""
+
+import json
+import logging
+import subprocess
+import weakref
+import cv2
+from numpy import frombuffer, uint8
+
+# Frames that are still in use are never overwritten, so this is only a guard
+# against a leak growing the pool forever
+MAX_BUFFERS = 256
+
+
+def probe(url: str, ffprobe: str = "ffprobe") -> dict:
+    """
+    Find the width, height and FPS of the first video stream.
+    """
+    output = subprocess.run(
+        [ffprobe, "-v", "error", "-select_streams", "v:0",
+         "-show_entries", "stream=width,height,r_frame_rate", "-of", "json", url],
+        capture_output=True, check=True, timeout=30,
+    ).stdout
+    stream = json.loads(output)["streams"][0]
+    numerator, _, denominator = stream["r_frame_rate"].partition("/")
+    return {
+        "width": int(stream["width"]),
+        "height": int(stream["height"]),
+        "fps": int(numerator) / int(denominator or 1),
+    }
+
+
+class FFmpegCapture():
+    """
+    Implements the parts of `cv2.VideoCapture` that StreamWatch uses.
+    """
+
+    def __init__(self,
+                 url: str,
+                 width: int = None,
+                 fps: int = None,
+                 keyframes_only: bool = False,
+                 buffers: int = 8,
+                 ffmpeg: str = "ffmpeg",
+                 ffprobe: str = "ffprobe",
+                ):
+        source = probe(url, ffprobe)
+        self.width, self.height = source["width"], source["height"]
+        if width and width < self.width:
+            # Most encoders and filters need even dimensions
+            self.height = round(self.height * width / self.width / 2) * 2
+            self.width = width
+        # Keyframes come once per GOP, which ffprobe can't tell us
+        self.fps = fps or (1 if keyframes_only else source["fps"])
+        self.frame_bytes = self.width * self.height * 3
+        self.frames_read = 0
+
+        command = [ffmpeg, "-hide_banner", "-loglevel", "error", "-nostdin"]
+        if url.startswith("rtsp://"):
+            command += ["-rtsp_transport", "tcp"]
+        if keyframes_only:
+            command += ["-skip_frame", "nokey"]
+        command += ["-i", url, "-an", "-sn"]
+
+        filters = []
+        if (self.width, self.height) != (source["width"], source["height"]):
+            filters.append(f"scale={self.width}:{self.height}")
+        if fps:
+            filters.append(f"fps={fps}")
+        if filters:
+            command += ["-vf", ",".join(filters)]
+        if keyframes_only:
+            command += ["-vsync", "passthrough"]
+        command += ["-f", "rawvideo", "-pix_fmt", "bgr24", "pipe:1"]
+
+        logging.debug(f"Starting ffmpeg: {' '.join(command)}")
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE, bufsize=0)
+
+        self._buffers = [bytearray(self.frame_bytes) for _ in range(max(buffers, 1))]
+        # A weak reference to the flat array of the last frame read into each buffer
+        self._in_use = [None] * len(self._buffers)
+
+    def _free_buffer(self) -> int:
+        for i, in_use in enumerate(self._in_use):
+            if in_use is None or in_use() is None:
+                return i
+        if len(self._buffers) >= MAX_BUFFERS:
+            raise MemoryError(f"All {MAX_BUFFERS} frame buffers are still in use.")
+        logging.debug(f"All frame buffers are in use. Growing the pool to {len(self._buffers) + 1}.")
+        self._buffers.append(bytearray(self.frame_bytes))
+        self._in_use.append(None)
+        return len(self._buffers) - 1
+
+    def isOpened(self) -> bool:
+        return self.process.poll() is None
+
+    def read(self) -> tuple:
+        slot = self._free_buffer()
+        view = memoryview(self._buffers[slot])
+        filled = 0
+        while filled < self.frame_bytes:
+            count = self.process.stdout.readinto(view[filled:])
+            if not count:
+                # ffmpeg has exited (or the stream ended)
+                return False, None
+            filled += count
+
+        self.frames_read += 1
+        flat = frombuffer(self._buffers[slot], dtype=uint8)
+        self._in_use[slot] = weakref.ref(flat)
+        return True, flat.reshape(self.height, self.width, 3)
+
+    def get(self, prop: int) -> float:
+        if prop == cv2.CAP_PROP_FPS:
+            return self.fps
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return self.width
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return self.height
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            return self.frames_read
+        return 0
+
+    def release(self) -> None:
+        if self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+        self.process.stdout.close()
@@ -0,0 +1,236 @@
+"""
+Frame Reader
+
+Reads frames from a capture (such as a `cv2.VideoCapture`) on a dedicated
+thread, and stores them in a small fixed-size ring. This means a slow consumer
+never stops the stream from being decoded - instead, frames are dropped
+according to the chosen policy, and the drops are counted.
+
+Policies:
+ - drop-oldest: When the ring is full, the oldest frame is thrown away.
+ - drop-newest: When the ring is full, the newly decoded frame is thrown away.
+ - latest: Only the most recent frame is kept. Anything unread is discarded.
+ - block: Nothing is dropped. Decoding waits for the consumer (for files).
+
+A capture that keeps failing (e.g: an RTSP stream that has dropped, which
+`isOpened()` doesn't notice) is given up on after "max_failures" failed reads
+in a row. If there's a "reconnect" function, the capture is reopened on the
+reader's own thread instead, waiting longer after each failed attempt, so the
+consumer never waits on a reconnect.
+"""
+
+import time
+import logging
+import threading
+from collections import deque, namedtuple
+
+from local_utilities.backoff import Backoff
+
+DROP_OLDEST = "drop-oldest"
+DROP_NEWEST = "drop-newest"
+KEEP_LATEST = "latest"
+BLOCK = "block"
+DROP_POLICIES = (DROP_OLDEST, DROP_NEWEST, KEEP_LATEST, BLOCK)
+
+# index is the number of frames read from the capture (including dropped ones)
+# side_data is anything else the capture provides with each frame (e.g: motion vectors)
+CapturedFrame = namedtuple("CapturedFrame", ["ok", "frame", "index", "timestamp", "side_data"], defaults=(None,))
+
+
+class FrameReader():
+    """
+    Decodes frames on a background thread, into a bounded ring.
+
+    Usage:
+        reader = FrameReader(cv2.VideoCapture(url), size=4, policy=DROP_OLDEST)
+        reader.start()
+        while reader.isOpened():
+            captured = reader.read()
+    """
+
+    def __init__(self,
+                 capture,
+                 size: int = 4,
+                 policy: str = DROP_OLDEST,
+                 metrics=None,
+                 stage: str = "decode",
+                 retrieve=None,
+                 reconnect=None,
+                 max_failures: int = 10,
+                ):
+        if policy not in DROP_POLICIES:
+            raise ValueError(f"Unknown drop policy '{policy}'. Expected one of {DROP_POLICIES}.")
+
+        self.capture = capture
+        self.policy = policy
+        # Optional local_utilities.metrics.Metrics, to time decoding as "stage"
+        self.metrics = metrics
+        self.stage = stage
+        # Optional "retrieve(index) -> bool". Frames it says no to are only
+        # grabbed (with `capture.grab()`), and never converted or queued.
+        self.retrieve = retrieve
+        # Optional "reconnect() -> capture", to reopen the capture when it fails
+        self.reconnect = reconnect
+        self.max_failures = max(max_failures, 1)
+        self._backoff = Backoff()
+        self.size = 1 if policy == KEEP_LATEST else max(size, 1)
+
+        self._ring = deque()
+        self._condition = threading.Condition()
+        self._thread = None
+        self._running = False
+
+        # Counters
+        self.frames_read = 0
+        self.frames_dropped = 0
+        self.frames_skipped = 0
+        self.read_failures = 0
+        self.max_depth = 0
+        self.reconnects = 0
+
+    @property
+    def depth(self) -> int:
+        return len(self._ring)
+
+    def start(self) -> None:
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="frame-reader", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._running = False
+        with self._condition:
+            self._condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def reopen(self, capture) -> None:
+        """
+        Swap in a new capture (e.g: after reconnecting to a stream). Anything
+        still in the ring is discarded, but the counters carry on.
+        """
+        self.stop()
+        with self._condition:
+            self._ring.clear()
+        self.capture = capture
+        self.start()
+
+    def isOpened(self) -> bool:
+        """
+        True while there are frames left to read, or more may still arrive.
+        """
+        return self._running or len(self._ring) > 0
+
+    def read(self, timeout: float = None) -> CapturedFrame:
+        """
+        Return the next frame from the ring, waiting for one if it is empty.
+
+        If no frame arrives before the timeout (or the reader stops), then a
+        failed CapturedFrame is returned, exactly like a failed `cap.read()`.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._ring or not self._running, timeout=timeout)
+            if not self._ring:
+                return CapturedFrame(False, None, self.frames_read, time.monotonic())
+            captured = self._ring.popleft()
+            # Wake the reader, in case it is blocked waiting for space
+            self._condition.notify_all()
+            return captured
+
+    def read_until(self, timestamp: float) -> list:
+        """
+        Take every frame that was captured up to "timestamp", without waiting.
+        """
+        frames = []
+        with self._condition:
+            while self._ring and self._ring[0].timestamp <= timestamp:
+                frames.append(self._ring.popleft())
+            if frames:
+                self._condition.notify_all()
+        return frames
+
+    def _run(self) -> None:
+        try:
+            self._read_frames()
+        except Exception:
+            # Otherwise `read()` would wait forever for a frame that never comes
+            logging.exception("Frame reader failed. Stopping it.")
+        finally:
+            with self._condition:
+                self._running = False
+                self._condition.notify_all()
+
+    def _read_frames(self) -> None:
+        failures = 0
+        while self._running:
+            if not self.capture.isOpened() or failures >= self.max_failures:
+                if self.reconnect is None:
+                    logging.warning("Capture is no longer open (or keeps failing). Stopping frame reader.")
+                    break
+                if not self._reconnect():
+                    break
+                failures = 0
+
+            if self.retrieve is not None and not self.retrieve(self.frames_read + 1):
+                # Keep up with the stream, without converting the frame
+                ok = self.capture.grab()
+                self.frames_read += 1
+                self.frames_skipped += 1
+            else:
+                decode_start = time.perf_counter()
+                ok, frame = self.capture.read()
+                if self.metrics is not None:
+                    self.metrics.observe(self.stage, time.perf_counter() - decode_start)
+                self.frames_read += 1
+                side_data = getattr(self.capture, "side_data", None)
+                self._put(CapturedFrame(ok, frame, self.frames_read, time.monotonic(), side_data))
+
+            if ok:
+                failures = 0
+                self._backoff.reset()
+            else:
+                failures += 1
+                self.read_failures += 1
+
+    def _reconnect(self) -> bool:
+        """
+        Reopen the capture, waiting longer (with some jitter) after each failed
+        attempt. Returns False if the reader was stopped first.
+        """
+        logging.warning("Lost the capture. Reconnecting.")
+        self.capture.release()
+        while True:
+            # Wait on the condition, so that `stop()` doesn't have to wait for the backoff
+            with self._condition:
+                if self._condition.wait_for(lambda: not self._running, timeout=self._backoff.next()):
+                    return False
+            try:
+                capture = self.reconnect()
+            except Exception as e:
+                logging.warning(f"Failed to reconnect: {e}")
+                continue
+            if capture.isOpened():
+                break
+            logging.warning("Failed to reconnect.")
+            capture.release()
+
+        self.capture = capture
+        self.reconnects += 1
+        logging.info("Reconnected the capture.")
+        return True
+
+    def _put(self, captured: CapturedFrame) -> None:
+        with self._condition:
+            if self.policy == BLOCK:
+                self._condition.wait_for(lambda: len(self._ring) < self.size or not self._running)
+            elif len(self._ring) >= self.size:
+                self.frames_dropped += 1
+                if self.policy == DROP_NEWEST:
+                    return
+                # DROP_OLDEST and KEEP_LATEST both discard the stale frame
+                self._ring.popleft()
+
+            self._ring.append(captured)
+            self.max_depth = max(self.max_depth, len(self._ring))
+            self._condition.notify_all()
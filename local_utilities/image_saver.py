@@ -4,17 +4,23 @@ Image Saver
 This utility is designed to accomodate the easy recording of images as either
 many image files or a single video file.
 
-It is designed to run as a thread/process, and read the image from a pipe.
+It is designed to run as a thread/process, and read the image from either a
+pipe, or a SharedFrameRing (which avoids pickling every frame).
 """
 
 from multiprocessing import Pipe
 
 from local_utilities import image_utils
+from local_utilities.shared_frames import SharedFrameRing
 
 def image_saver(pipe: Pipe):
     print("STARTED IMAGE SAVER!")
-    in_pipe, out_pipe = pipe
-    out_pipe.close()
+    if isinstance(pipe, SharedFrameRing):
+        # The ring has the same recv()/close() interface as a pipe
+        in_pipe = pipe
+    else:
+        in_pipe, out_pipe = pipe
+        out_pipe.close()
 
     try:
         while not in_pipe.closed:
@@ -2,7 +2,12 @@
 
 import cv2
 import imutils
-from numpy import ndarray as np_image, array, uint8
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from numpy import ndarray as np_image, array, empty, uint8, int16, float32
+
+# Per-channel statistics from a sample of an image. See `channel_stats`.
+ChannelStats = namedtuple("ChannelStats", ["means", "brightness", "spread", "grey_fraction"])
 
 circle = array([
     [0, 0, 1, 1, 1, 0, 0],
@@ -14,14 +19,134 @@ circle = array([
     [0, 0, 1, 1, 1, 0, 0],
 ], dtype=uint8)
 
+class DetectionWorkspace():
+    """
+    The working buffers for the detection pipeline. Each buffer is allocated
+    the first time it's needed (or when the resolution changes), and is then
+    reused for every frame, as the "dst" of the OpenCV calls.
+
+    Anything returned using a workspace is overwritten by the next frame.
+    """
+
+    def __init__(self):
+        self._buffers = {}
+        self.allocations = 0
+
+    def buffer(self, name: str, shape: tuple, dtype=uint8) -> np_image:
+        buffer = self._buffers.get(name)
+        if buffer is None or buffer.shape != shape or buffer.dtype != dtype:
+            buffer = empty(shape, dtype=dtype)
+            self._buffers[name] = buffer
+            self.allocations += 1
+        return buffer
+
+    @property
+    def nbytes(self) -> int:
+        return sum(buffer.nbytes for buffer in self._buffers.values())
+
+class BandPool():
+    """
+    Splits image work into horizontal bands, and runs them on a thread pool.
+    OpenCV releases the GIL, so the bands run on separate cores.
+
+    Per-pixel work (e.g: absdiff, threshold) splits exactly. Neighbourhood
+    work (e.g: dilate) reads a margin of extra rows either side of its band,
+    so the result is exactly the same as doing the whole image at once.
+    """
+
+    def __init__(self, bands: int = 4):
+        self.bands = max(bands, 1)
+        self._pool = ThreadPoolExecutor(max_workers=self.bands, thread_name_prefix="detect-band")
+
+    def ranges(self, height: int) -> list:
+        """
+        The (top, bottom) rows of each band.
+        """
+        bands = min(self.bands, height)
+        return [(height * i // bands, height * (i + 1) // bands) for i in range(bands)]
+
+    def map(self, function, height: int) -> None:
+        """
+        Call "function(top, bottom)" for each band, and wait for them all.
+        """
+        for future in [self._pool.submit(function, top, bottom) for top, bottom in self.ranges(height)]:
+            # Raises any exception from the band
+            future.result()
+
+    def dilate(self, src: np_image, kernel: np_image, iterations: int, dst: np_image) -> np_image:
+        """
+        The same as `cv2.dilate(src, kernel, dst=dst, iterations=iterations)`.
+        """
+        # Each iteration can spread a pixel this many rows
+        margin = (kernel.shape[0] // 2) * iterations
+        height = src.shape[0]
+
+        def dilate_band(top, bottom):
+            outer_top, outer_bottom = max(top - margin, 0), min(bottom + margin, height)
+            band = cv2.dilate(src[outer_top:outer_bottom], kernel, iterations=iterations)
+            dst[top:bottom] = band[top - outer_top:bottom - outer_top]
+
+        self.map(dilate_band, height)
+        return dst
+
+    def close(self) -> None:
+        self._pool.shutdown(wait=True)
+
+def shrink_image(image: np_image,
+                 working_width: int = None,
+                 pyramid_level: int = None,
+                 workspace: DetectionWorkspace = None,
+                ) -> (np_image, float):
+    """
+    Shrink an image for cheaper analysis, either to a working width, or by
+    halving it several times (pyramid levels). Never enlarges the image.
+
+    Returns the shrunk image, and the factor it was shrunk by.
+    """
+    width = image.shape[1]
+
+    if pyramid_level:
+        for level in range(pyramid_level):
+            dst = None
+            if workspace is not None:
+                shape = ((image.shape[0] + 1) // 2, (image.shape[1] + 1) // 2, *image.shape[2:])
+                dst = workspace.buffer(f"pyramid{level}", shape)
+            image = cv2.pyrDown(image, dst=dst)
+    elif working_width and working_width < width:
+        height = round(image.shape[0] * working_width / width)
+        dst = None
+        if workspace is not None:
+            dst = workspace.buffer("shrunk", (height, working_width, *image.shape[2:]))
+        image = cv2.resize(image, (working_width, height), dst=dst, interpolation=cv2.INTER_AREA)
+
+    return image, width / image.shape[1]
+
+def scale_box(box: tuple, factor: float) -> tuple:
+    """
+    Scale an (x, y, w, h) box, e.g: from a shrunk image back to the original.
+    """
+    if factor == 1:
+        return box
+    return tuple(int(round(v * factor)) for v in box)
+
+def blur_size(scale: float) -> int:
+    """
+    The size of the blur kernel for an image of this scale. It's 25x25 at
+    1080p (scale 10), and must always be odd.
+    """
+    return max(int(scale * 2.5) | 1, 3)
+
 def simplify_image(image: np_image,
                    width: int = None,
                    blur: bool = False,
                    greyscale: bool = False,
                    outline: bool = False,
+                   blur_size: int = 25,
+                   workspace: DetectionWorkspace = None,
                   ) -> np_image:
     """
     Simplify an image, by shrinking, blurring, greyscaling, outlining.
+    With a workspace, nothing is allocated (except when shrinking by width).
     """
     # Shrink the image
     if width is not None:
@@ -30,46 +155,130 @@ def simplify_image(image: np_image,
     # Convert to greyscale
     if greyscale:
         conversion = cv2.COLOR_BGR2GRAY  # cv2.IMREAD_GRAYSCALE
-        image = cv2.cvtColor(image, conversion)
+        dst = workspace.buffer("grey", image.shape[:2]) if workspace is not None else None
+        image = cv2.cvtColor(image, conversion, dst=dst)
 
     # Blur the image
     if blur:
-        # FIXME - Maybe base this on scale? Maybe not.
-        image = cv2.GaussianBlur(image, (25, 25), 0)
+        dst = workspace.buffer("blurred", image.shape) if workspace is not None else None
+        image = cv2.GaussianBlur(image, (blur_size, blur_size), 0, dst=dst)
 
     # Convert to outlines
     if outline:
-        image = cv2.Canny(image, 50, 200)
+        dst = workspace.buffer("outline", image.shape[:2]) if workspace is not None else None
+        image = cv2.Canny(image, 50, 200, edges=dst)
 
     return image
 
-def is_greyscale(image: np_image) -> bool:
+def channel_stats(image: np_image, stride: int = 16, tolerance: int = 12) -> ChannelStats:
     """
-    Sample every 100th pixel in each row and column of the image.
-    If they're all grey, then the image is probably greyscale.
+    Sample every "stride"th pixel in each row and column of a BGR image, and
+    work out some statistics about its colour channels.
+
+    A pixel counts as grey if its channels are all within "tolerance" of each
+    other. IR cameras are rarely perfectly grey, so this shouldn't be 0.
     """
     if len(image.shape) == 2:
         # Only height and width dimensions (no color dimension)
-        return True
+        brightness = float(image[::stride, ::stride].mean())
+        return ChannelStats((brightness,) * 3, brightness, 0.0, 1.0)
+
+    sample = image[::stride, ::stride].astype(int16)
+    spread = sample.max(axis=2) - sample.min(axis=2)
+    means = tuple(float(m) for m in sample.mean(axis=(0, 1)))
+
+    return ChannelStats(
+        means=means,
+        brightness=sum(means) / len(means),
+        spread=float(spread.mean()),
+        grey_fraction=float((spread <= tolerance).mean()),
+    )
+
+def is_greyscale(image: np_image, stride: int = 16, tolerance: int = 12, min_fraction: float = 0.98) -> bool:
+    """
+    If (almost) all of the sampled pixels are grey, the image is probably greyscale.
+    """
+    return channel_stats(image, stride, tolerance).grey_fraction >= min_fraction
+
+def difference_hash(image: np_image, size: int = 8) -> int:
+    """
+    A perceptual hash (dHash) of an image, as a "size" * "size" bit integer.
+    Each bit is whether a pixel of a tiny greyscale thumbnail is brighter
+    than the one to its right, so similar images have similar hashes.
+    """
+    # Shrinking first means only the tiny thumbnail is converted to grey
+    thumbnail = cv2.resize(image, (size + 1, size), interpolation=cv2.INTER_AREA)
+    if thumbnail.ndim == 3:
+        thumbnail = cv2.cvtColor(thumbnail, cv2.COLOR_BGR2GRAY)
+    bits = (thumbnail[:, 1:] > thumbnail[:, :-1]).flatten()
+    return int("".join("1" if bit else "0" for bit in bits), 2)
+
+def hamming_distance(a: int, b: int) -> int:
+    """
+    The number of bits that differ between two hashes.
+    """
+    return bin(a ^ b).count("1")
+
+class NightvisionClassifier():
+    """
+    Decides whether a camera is in nightvision (greyscale) mode.
+
+    This is cheap enough to update every frame. To stop it flickering between
+    modes, it uses hysteresis: it has to see "hold" frames in a row that are
+    clearly in the other mode before it changes its mind.
+
+    The statistics from the latest frame are kept in `stats`, for reuse.
+    """
+
+    def __init__(self,
+                 stride: int = 16,
+                 tolerance: int = 12,
+                 enter_fraction: float = 0.98,
+                 exit_fraction: float = 0.90,
+                 hold: int = 25,
+                ):
+        self.stride = stride
+        self.tolerance = tolerance
+        self.enter_fraction = enter_fraction
+        self.exit_fraction = exit_fraction
+        self.hold = max(hold, 1)
+
+        self.nightvision = False
+        self.stats = None
+        self._streak = 0
+
+    def update(self, image: np_image) -> bool:
+        """
+        Classify a frame, and return whether the camera is in nightvision mode.
+        """
+        self.stats = channel_stats(image, self.stride, self.tolerance)
 
-    height, width = image.shape[:2]
+        if self.nightvision:
+            disagrees = self.stats.grey_fraction < self.exit_fraction
+        else:
+            disagrees = self.stats.grey_fraction >= self.enter_fraction
 
-    for col in range(0, width, 100):  # e.g: 1920
-        for row in range(0, height, 100):  # e.g: 1080
-            pixel = image[row][col]
-            # The RGB values must all be identical, or the pixel is non-grey
-            if not pixel[0] == pixel[1] == pixel[2]:
-                return False
+        self._streak = self._streak + 1 if disagrees else 0
+        if self._streak >= self.hold:
+            self.nightvision = not self.nightvision
+            self._streak = 0
 
-    return True
+        return self.nightvision
 
-def detect_motion(old_image: np_image, new_image: np_image, scale: float, sensitive: bool):
+def detect_motion(old_image: np_image, new_image: np_image, scale: float, sensitive: bool, shrink: float = 1, mask: np_image = None):
     """
     Compare two images. If there is motion, it will return a box around the
     largest area that had motion.
 
     The images to be compared MUST be binary images (greyscale).
 
+    The scale is that of the original image. If the images were shrunk (see
+    `shrink_image`), then the dilation and minimum area are shrunk to match,
+    and the box is mapped back to the original image's coordinates.
+
+    If there's a mask (the same size as the images), motion is only looked
+    for where it's non-zero.
+
     All credit goes to this fantastic article.
     https://www.pyimagesearch.com/2015/05/25/basic-motion-detection-and-tracking-with-python-and-opencv/
     """
@@ -85,12 +294,35 @@ def detect_motion(old_image: np_image, new_image: np_image, scale: float, sensit
     # Only keep areas that have changed by a significant value
     sensitity = 15 if sensitive else 40
     _, delta = cv2.threshold(delta, sensitity, 255, cv2.THRESH_BINARY)
+    if mask is not None:
+        cv2.bitwise_and(delta, mask, dst=delta)
 
+    return largest_motion_area(delta, scale, shrink)
+
+def largest_motion_area(delta: np_image,
+                        scale: float,
+                        shrink: float = 1,
+                        workspace: DetectionWorkspace = None,
+                        bands: BandPool = None,
+                       ) -> tuple:
+    """
+    Find a box around the largest area of motion in a thresholded (binary)
+    image, in the original image's coordinates. See `detect_motion`.
+
+    With a BandPool, the dilation is split into bands. The contours are
+    still found in the whole image, so shapes that cross between bands are
+    joined up exactly as they would be without it.
+    """
     # Dilate just expands/bleeds/dilates shapes. This means a tiny circle would
     # grow in size. A donut shape might expand to a large circle (with no hole).
     # FIXME - https://www.geeksforgeeks.org/erosion-dilation-images-using-opencv-python/
 
-    delta = cv2.dilate(delta, circle, iterations=int(scale * 1.5))
+    dst = workspace.buffer("dilated", delta.shape) if workspace is not None else None
+    iterations = max(int(scale * 1.5 / shrink), 1)
+    if bands is not None:
+        delta = bands.dilate(delta, circle, iterations, dst if dst is not None else empty(delta.shape, dtype=uint8))
+    else:
+        delta = cv2.dilate(delta, circle, dst=dst, iterations=iterations)
 
     cnts = cv2.findContours(delta, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
     cnts = imutils.grab_contours(cnts)
@@ -100,7 +332,7 @@ def detect_motion(old_image: np_image, new_image: np_image, scale: float, sensit
     for c in cnts:
         # Ignore areas that are too small
         area = cv2.contourArea(c)
-        if area < (200 * scale):
+        if area < (200 * scale / shrink ** 2):
             continue
 
         (x, y, w, h) = cv2.boundingRect(c)
@@ -109,7 +341,246 @@ def detect_motion(old_image: np_image, new_image: np_image, scale: float, sensit
         if w * h > largest_motion[2] * largest_motion[3]:
             largest_motion = (x, y, w, h)
 
-    return largest_motion
+    return scale_box(largest_motion, shrink)
+
+class MotionDetector():
+    """
+    Detects motion in a sequence of simplified (greyscale, blurred) images.
+
+    Subclasses implement `foreground()`, which returns a binary image of
+    everything that moved, and keep whatever history they need in buffers
+    that are allocated once, on the first frame. The binary image is one of
+    those buffers, so it's overwritten by the next frame.
+
+    If "bands" is set to a BandPool, the per-pixel work and the dilation are
+    split into horizontal bands, on threads.
+
+    The analysis FPS and resolution can change while a detector is running
+    (e.g: when the load controller sheds load). Detectors keep the history
+    they already have, rather than starting from scratch.
+    """
+
+    bands = None
+
+    def set_fps(self, fps: int) -> None:
+        """
+        Size the history for images arriving at this rate.
+        """
+        raise NotImplementedError
+
+    def per_band(self, function, height: int) -> None:
+        """
+        Call "function(top, bottom)" for each band (or the whole image).
+        """
+        if self.bands is None:
+            function(0, height)
+        else:
+            self.bands.map(function, height)
+
+    def foreground(self, image: np_image, sensitive: bool) -> np_image:
+        """
+        Update the history with a new image, and return a binary image of the
+        areas that have moved (or None if there's not enough history yet).
+        """
+        raise NotImplementedError
+
+    def detect(self,
+               image: np_image,
+               scale: float,
+               sensitive: bool,
+               shrink: float = 1,
+               mask: np_image = None,
+               workspace: DetectionWorkspace = None,
+              ) -> tuple:
+        """
+        Return a box around the largest area of motion. See `detect_motion`.
+        """
+        if len(image.shape) >= 3:
+            raise SystemExit("Can only detect motion on greyscale images.")
+
+        delta = self.foreground(image, sensitive)
+        if delta is None:
+            return (0, 0, 0, 0)
+        if mask is not None:
+            # Keep the history of the whole image, but ignore masked motion
+            def apply_mask(top, bottom):
+                cv2.bitwise_and(delta[top:bottom], mask[top:bottom], dst=delta[top:bottom])
+            self.per_band(apply_mask, delta.shape[0])
+        return largest_motion_area(delta, scale, shrink, workspace, self.bands)
+
+class FrameDiffDetector(MotionDetector):
+    """
+    Compares each image to the one from "history" frames ago.
+    The old images are kept in a fixed-size ring, rather than a list.
+
+    When the history changes, the images already in the ring are kept. Until
+    the ring fills up again, images are compared to the oldest one there is.
+    When the resolution changes, the old images are resized.
+    """
+
+    def __init__(self, history: int = 1):
+        self.history = max(history, 1)
+        self._frames = None
+        self._delta = None
+        self._count = 0
+        # Whether to compare against a partly full ring (after a change)
+        self._resumed = False
+
+    def set_fps(self, fps: int) -> None:
+        # Compare to the frame from half a second ago
+        self.set_history(max(fps // 2, 1))
+
+    def set_history(self, history: int) -> None:
+        history = max(history, 1)
+        if history == self.history:
+            return
+        if self._frames is not None:
+            kept = self._ordered_frames()[-history:]
+            frames = empty((history, *self._frames.shape[1:]), dtype=self._frames.dtype)
+            for i, frame in enumerate(kept):
+                frames[i] = frame
+            self._frames = frames
+            self._count = len(kept)
+            self._resumed = self._count > 0
+        self.history = history
+
+    def _ordered_frames(self) -> list:
+        """
+        The images in the ring, oldest first.
+        """
+        if self._count < self.history:
+            return [self._frames[i] for i in range(self._count)]
+        start = self._count % self.history
+        return [self._frames[(start + i) % self.history] for i in range(self.history)]
+
+    def foreground(self, image: np_image, sensitive: bool) -> np_image:
+        if self._frames is None:
+            self._frames = empty((self.history, *image.shape), dtype=image.dtype)
+            self._delta = empty(image.shape, dtype=uint8)
+            self._count = 0
+        elif self._frames.shape[1:] != image.shape:
+            # The analysis resolution changed. Scale the history, rather than losing it.
+            frames = empty((self.history, *image.shape), dtype=image.dtype)
+            for i in range(min(self._count, self.history)):
+                cv2.resize(self._frames[i], (image.shape[1], image.shape[0]), dst=frames[i], interpolation=cv2.INTER_AREA)
+            self._frames = frames
+            self._delta = empty(image.shape, dtype=uint8)
+
+        slot = self._count % self.history
+        newest, delta = self._frames[slot], self._delta
+        old = None
+        if self._count >= self.history:
+            old = newest
+        elif self._resumed:
+            # The ring hasn't wrapped around yet, so the oldest is first
+            old = self._frames[0]
+        sensitity = 15 if sensitive else 40
+
+        def diff(top, bottom):
+            if old is not None:
+                cv2.absdiff(image[top:bottom], old[top:bottom], dst=delta[top:bottom])
+                cv2.threshold(delta[top:bottom], sensitity, 255, cv2.THRESH_BINARY, dst=delta[top:bottom])
+            newest[top:bottom] = image[top:bottom]
+
+        self.per_band(diff, image.shape[0])
+        self._count += 1
+        return delta if old is not None else None
+
+class RunningAverageDetector(MotionDetector):
+    """
+    Compares each image to an exponentially weighted running average of
+    the previous images. Slow changes (e.g: the sun setting) are absorbed
+    into the background.
+    """
+
+    def __init__(self, alpha: float = 0.1):
+        self.alpha = alpha
+        self._average = None
+        self._background = None
+        self._delta = None
+
+    def set_fps(self, fps: int) -> None:
+        # Average over roughly the last second. A new rate blends in gradually.
+        self.alpha = 2 / (max(fps, 1) + 1)
+
+    def foreground(self, image: np_image, sensitive: bool) -> np_image:
+        if self._average is None:
+            self._average = image.astype(float32)
+            self._background = empty(image.shape, dtype=uint8)
+            self._delta = empty(image.shape, dtype=uint8)
+            return None
+        if self._average.shape != image.shape:
+            # The analysis resolution changed. Scale the average, rather than losing it.
+            self._average = cv2.resize(self._average, (image.shape[1], image.shape[0]), interpolation=cv2.INTER_AREA)
+            self._background = empty(image.shape, dtype=uint8)
+            self._delta = empty(image.shape, dtype=uint8)
+
+        average, background, delta = self._average, self._background, self._delta
+        sensitity = 15 if sensitive else 40
+
+        def diff(top, bottom):
+            cv2.convertScaleAbs(average[top:bottom], dst=background[top:bottom])
+            cv2.absdiff(image[top:bottom], background[top:bottom], dst=delta[top:bottom])
+            cv2.accumulateWeighted(image[top:bottom], average[top:bottom], self.alpha)
+            cv2.threshold(delta[top:bottom], sensitity, 255, cv2.THRESH_BINARY, dst=delta[top:bottom])
+
+        self.per_band(diff, image.shape[0])
+        return delta
+
+class BackgroundSubtractorDetector(MotionDetector):
+    """
+    Uses one of OpenCV's background subtractors (MOG2 or KNN), which model
+    each pixel over the last "history" frames.
+
+    The model can't be resized, so the subtractor starts again (by itself)
+    if the resolution changes. A new history only changes how quickly it
+    learns, so it takes effect gradually.
+    """
+
+    def __init__(self, kind: str = "mog2", history: int = 250):
+        self.kind = kind
+        if kind == "mog2":
+            self._subtractor = cv2.createBackgroundSubtractorMOG2(history=history, detectShadows=False)
+        elif kind == "knn":
+            self._subtractor = cv2.createBackgroundSubtractorKNN(history=history, detectShadows=False)
+        else:
+            raise ValueError(f"Unknown background subtractor '{kind}'.")
+        self._sensitive = None
+        self._delta = None
+
+    def set_fps(self, fps: int) -> None:
+        # Model the last ten seconds
+        self._subtractor.setHistory(max(fps, 1) * 10)
+
+    def foreground(self, image: np_image, sensitive: bool) -> np_image:
+        if sensitive != self._sensitive:
+            self._sensitive = sensitive
+            if self.kind == "mog2":
+                self._subtractor.setVarThreshold(8 if sensitive else 16)
+            else:
+                self._subtractor.setDist2Threshold(200 if sensitive else 400)
+
+        if self._delta is None or self._delta.shape != image.shape:
+            self._delta = empty(image.shape, dtype=uint8)
+        return self._subtractor.apply(image, fgmask=self._delta)
+
+# The names of the available detectors
+MOTION_DETECTORS = ("framediff", "average", "mog2", "knn")
+
+def create_motion_detector(name: str, fps: int) -> MotionDetector:
+    """
+    Create a motion detector by name, with its history sized for the FPS.
+    """
+    if name == "framediff":
+        detector = FrameDiffDetector()
+    elif name == "average":
+        detector = RunningAverageDetector()
+    elif name in ("mog2", "knn"):
+        detector = BackgroundSubtractorDetector(name)
+    else:
+        raise ValueError(f"Unknown motion detector '{name}'. Expected one of {MOTION_DETECTORS}.")
+    detector.set_fps(fps)
+    return detector
 
 def show_image(image: np_image, title: str = "image"):
     # Show the image in a window, for debugging or visualisation purposes.
@@ -0,0 +1,136 @@
+"""
+Load Control
+
+Works out how much work a stream can afford to do, based on how long each
+frame takes to process, whether frames are being dropped, and (optionally)
+how hot the CPU is.
+
+When there isn't enough headroom, the controller steps down a ladder of
+cheaper settings: no debug rendering, then analysing fewer frames, then
+analysing smaller frames. When headroom returns, it steps back up.
+
+If there's no debug rendering to begin with, the step that only turns it
+off is skipped, as it wouldn't save anything.
+"""
+
+import time
+import logging
+
+# (analyse every nth frame, divide the analysis width by, render debug)
+LEVELS = (
+    (1, 1, True),
+    (1, 1, False),
+    (2, 1, False),
+    (2, 2, False),
+    (4, 2, False),
+    (4, 4, False),
+    (8, 4, False),
+)
+
+# The Raspberry Pi's CPU temperature, in millidegrees
+DEFAULT_TEMPERATURE_PATH = "/sys/class/thermal/thermal_zone0/temp"
+
+
+def read_temperature(path: str) -> float:
+    """
+    Read a temperature (in degrees) from a sysfs file, or None if we can't.
+    """
+    try:
+        with open(path, "r") as f:
+            return int(f.read().strip()) / 1000
+    except (OSError, ValueError):
+        return None
+
+
+class LoadController():
+    def __init__(self,
+                 fps: int,
+                 interval: float = 2,
+                 high_load: float = 0.9,
+                 low_load: float = 0.6,
+                 temperature_path: str = None,
+                 max_temperature: float = 75,
+                 debug: bool = True,
+                ):
+        self.levels = [
+            level for i, level in enumerate(LEVELS)
+            if debug or i == 0 or level[:2] != LEVELS[i - 1][:2]
+        ]
+        self.frame_budget = 1 / max(fps, 1)
+        self.interval = interval
+        self.high_load = high_load
+        self.low_load = low_load
+        self.temperature_path = temperature_path
+        self.max_temperature = max_temperature
+
+        self.level = 0
+        self.load = 0
+        self.temperature = None
+
+        self._busy = 0
+        self._frames = 0
+        self._dropped = 0
+        self._calm_intervals = 0
+        self._window_start = time.monotonic()
+
+    @property
+    def stride(self) -> int:
+        return self.levels[self.level][0]
+
+    @property
+    def width_divisor(self) -> int:
+        return self.levels[self.level][1]
+
+    @property
+    def debug(self) -> bool:
+        return self.levels[self.level][2]
+
+    def record(self, seconds: float) -> None:
+        """
+        Record how long it took to process a frame.
+        """
+        self._busy += seconds
+        self._frames += 1
+
+    def update(self, frames_dropped: int) -> bool:
+        """
+        Once per interval, decide whether to change level.
+        Returns True if the level changed.
+        """
+        now = time.monotonic()
+        if now - self._window_start < self.interval or not self._frames:
+            return False
+
+        # The fraction of each frame's time budget that was spent working
+        self.load = self._busy / self._frames / self.frame_budget
+        dropping = frames_dropped > self._dropped
+        hot = False
+        if self.temperature_path:
+            self.temperature = read_temperature(self.temperature_path)
+            hot = self.temperature is not None and self.temperature >= self.max_temperature
+
+        self._busy = self._frames = 0
+        self._dropped = frames_dropped
+        self._window_start = now
+
+        old_level = self.level
+        if self.load > self.high_load or dropping or hot:
+            self._calm_intervals = 0
+            self.level = min(self.level + 1, len(self.levels) - 1)
+        elif self.load < self.low_load:
+            # Only step back up once there's been headroom for a while
+            self._calm_intervals += 1
+            if self._calm_intervals >= 3:
+                self._calm_intervals = 0
+                self.level = max(self.level - 1, 0)
+        else:
+            self._calm_intervals = 0
+
+        if self.level != old_level:
+            direction = "Shedding load" if self.level > old_level else "Restoring load"
+            logging.info(
+                f"{direction} (load {self.load:.0%}, dropping {dropping}, temperature {self.temperature}). "
+                f"Level {self.level}: analysing every {self.stride} frames at 1/{self.width_divisor} width, debug {self.debug}."
+            )
+            return True
+        return False
@@ -0,0 +1,182 @@
+"""
+Metrics
+
+Cheap, in-process metrics: histograms of how long each stage takes, plus
+counters and gauges. They can be summarised as a log line, or served over
+HTTP in the Prometheus text format.
+
+Recording a timing is a perf_counter() call and a bisect into a fixed list of
+buckets, so it's cheap enough to do several times per frame.
+
+Stages are created by whichever thread first times them, so readers (e.g:
+the HTTP server) always iterate over a snapshot of them.
+"""
+
+import time
+import logging
+import threading
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Upper bounds of the histogram buckets, in seconds (0.5ms to 5s)
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.002, 0.005,
+    0.01, 0.02, 0.04, 0.08,
+    0.16, 0.32, 0.64, 1.28,
+    2.5, 5.0,
+)
+
+
+class Histogram():
+    def __init__(self, buckets: tuple = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # The last count is for anything bigger than the biggest bucket
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """
+        Estimate a quantile, as the upper bound of the bucket it falls into.
+        """
+        target = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float("inf")
+
+
+class _Timer():
+    __slots__ = ("histogram", "start")
+
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Metrics():
+    """
+    A collection of stage timings, counters and gauges, with shared labels
+    (e.g: the camera name).
+
+    Counters and gauges are functions, so that values which are already
+    counted elsewhere (e.g: by the frame reader) don't need counting twice.
+    """
+
+    def __init__(self, prefix: str, labels: dict = None):
+        self.prefix = prefix
+        self.labels = labels or {}
+        self.stages = {}
+        self.counters = {}
+        self.gauges = {}
+
+    def stage(self, name: str) -> _Timer:
+        """
+        Time a stage, e.g: `with metrics.stage("decode"): ...`
+        """
+        return _Timer(self.histogram(name))
+
+    def histogram(self, name: str) -> Histogram:
+        histogram = self.stages.get(name)
+        if histogram is None:
+            # Two threads may race to create it, so only the first one wins
+            histogram = self.stages.setdefault(name, Histogram())
+        return histogram
+
+    def observe(self, name: str, seconds: float) -> None:
+        self.histogram(name).observe(seconds)
+
+    def counter(self, name: str, function) -> None:
+        self.counters[name] = function
+
+    def gauge(self, name: str, function) -> None:
+        self.gauges[name] = function
+
+    def summary(self) -> str:
+        """
+        A one-line summary, for logging.
+        """
+        stages = ", ".join(
+            f"{name} {1000 * h.sum / h.count:.1f}ms (p90<{1000 * h.quantile(0.9):g}ms)"
+            for name, h in list(self.stages.items()) if h.count
+        )
+        counters = ", ".join(f"{name} {function()}" for name, function in list(self.counters.items()))
+        gauges = ", ".join(f"{name} {function()}" for name, function in list(self.gauges.items()))
+        return f"Stages: {stages}. Counters: {counters}. Gauges: {gauges}."
+
+    def render(self) -> str:
+        """
+        All of the metrics, in the Prometheus text format.
+        """
+        lines = []
+
+        def labels(**extra) -> str:
+            merged = {**self.labels, **extra}
+            return "{" + ",".join(f'{key}="{value}"' for key, value in merged.items()) + "}"
+
+        name = f"{self.prefix}_stage_seconds"
+        lines.append(f"# TYPE {name} histogram")
+        for stage, histogram in list(self.stages.items()):
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{labels(stage=stage, le=bound)} {cumulative}")
+            lines.append(f"{name}_bucket{labels(stage=stage, le='+Inf')} {histogram.count}")
+            lines.append(f"{name}_sum{labels(stage=stage)} {histogram.sum}")
+            lines.append(f"{name}_count{labels(stage=stage)} {histogram.count}")
+
+        for counter, function in list(self.counters.items()):
+            lines.append(f"# TYPE {self.prefix}_{counter}_total counter")
+            lines.append(f"{self.prefix}_{counter}_total{labels()} {function()}")
+
+        for gauge, function in list(self.gauges.items()):
+            lines.append(f"# TYPE {self.prefix}_{gauge} gauge")
+            lines.append(f"{self.prefix}_{gauge}{labels()} {function()}")
+
+        return "\n".join(lines) + "\n"
+
+
+class MetricsServer():
+    """
+    Serves metrics at http://<host>:<port>/metrics, from a background thread.
+    """
+
+    def __init__(self, metrics: Metrics, port: int, host: str = "127.0.0.1"):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # Don't log every scrape
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="metrics-server", daemon=True)
+        self.thread.start()
+        logging.info(f"Serving metrics at http://{host}:{port}/metrics.")
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
@@ -0,0 +1,157 @@
+"""
+Motion Analysis
+
+The analysis that StreamWatch does to each frame live, and that batch and
+the benchmark do to recorded footage:
+ - FrameAnalyser: classify nightvision, crop to the region mask, shrink,
+   simplify, and detect the largest area of motion.
+ - MotionTracker: turn those areas into motion that starts, continues, and
+   stops, a few seconds after the last movement.
+
+Everything shares these, so footage that's re-analysed later finds the same
+events as the live run did.
+"""
+
+import logging
+from contextlib import nullcontext
+
+from local_utilities import image_utils
+
+MAX_MOTION_SECONDS = 5
+
+# What a frame's motion did to the motion being tracked
+MOTION_STARTED = "started"
+MOTION_CONTINUING = "continuing"
+MOTION_STOPPED = "stopped"
+
+
+class FrameAnalyser():
+    """
+    Finds the largest area of motion in each frame, in frame coordinates.
+
+    The detector is a MotionDetector, or a MotionVectorDetector (which uses
+    each frame's motion vectors, passed in as "side_data", and no pixels).
+    If "pixels" is False, the frames are blank, so nightvision isn't
+    classified, and the last known state is kept.
+
+    "width" and "pyramid_level" can be changed between frames (e.g: to shed
+    load). The detector keeps its history when they do.
+    """
+
+    def __init__(self,
+                 detector,
+                 width: int,
+                 height: int,
+                 fps: int,
+                 region_mask=None,
+                 analysis_width: int = None,
+                 pyramid_level: int = None,
+                 pixels: bool = True,
+                 metrics=None,
+                ):
+        self.detector = detector
+        self.region_mask = region_mask
+        self.width = analysis_width
+        self.pyramid_level = pyramid_level
+        self.pixels = pixels
+        # Optional local_utilities.metrics.Metrics, to time each step
+        self.metrics = metrics
+        self.vectors = not isinstance(detector, image_utils.MotionDetector)
+
+        # The scale is based on the smallest dimension. e.g: 1920x1080 = 10x
+        self.scale = min(width, height) // 100
+        # Must see a second of frames in the other mode before switching
+        self.classifier = image_utils.NightvisionClassifier(hold=max(fps, 1))
+        self.nightvision = False
+        # Analysis buffers are allocated once, rather than for every frame
+        self.workspace = image_utils.DetectionWorkspace()
+        self.frames_analysed = 0
+
+    def _stage(self, name: str):
+        return self.metrics.stage(name) if self.metrics is not None else nullcontext()
+
+    def analyse(self, frame, side_data=None) -> tuple:
+        """
+        Analyse a frame, and return a box around the largest area of motion.
+        """
+        self.frames_analysed += 1
+
+        # Check if we're nightvision (this is cheap, and won't flicker)
+        if self.pixels:
+            with self._stage("nightvision"):
+                nightvision = self.classifier.update(frame)
+            if self.nightvision != nightvision:
+                from_string, to_string = ("nightvision", "color") if self.nightvision else ("color", "nightvision")
+                logging.info(f"Changed from {from_string} to {to_string}.")
+                self.nightvision = nightvision
+
+        if self.vectors:
+            # The camera's encoder has already done the hard work
+            with self._stage("detect"):
+                return self.detector.detect(side_data, self.nightvision)
+
+        # The detector keeps track of the last several frames
+        # FIXME - maybe don't blur nightvision images? The greys REALLY blend together
+        # Analysis is done on a shrunk copy, so it costs the same at any resolution
+        with self._stage("simplify"):
+            width = self.width
+            if self.region_mask is not None:
+                # Nothing outside the mask's bounding box is analysed at all
+                frame = self.region_mask.crop(frame)
+                width = self.region_mask.crop_width(width)
+            small_frame, shrink = image_utils.shrink_image(frame, width, self.pyramid_level, self.workspace)
+            blur_size = image_utils.blur_size(self.scale / shrink)
+            simple = image_utils.simplify_image(small_frame, greyscale=True, blur=True, blur_size=blur_size, workspace=self.workspace)
+
+        # Detect motion (e.g: compare to several frames ago)
+        with self._stage("detect"):
+            if self.region_mask is None:
+                return self.detector.detect(simple, self.scale, self.nightvision, shrink, workspace=self.workspace)
+            mask = self.region_mask.mask_for(simple.shape)
+            motion_area = self.detector.detect(simple, self.scale, self.nightvision, shrink, mask, self.workspace)
+            return self.region_mask.to_frame(motion_area)
+
+
+class MotionTracker():
+    """
+    recent_motion is a measure of how much motion there has been over
+    the past few seconds. This value has a maximum value that it caps at.
+
+    If this value is already 0, then there has been no recent motion.
+
+    As soon as this value drops down from 1 to 0, a segment of recent motion
+    is said to have stopped.
+
+    TODO - Add a "threshold" here. A single frame of tiny movement should
+    not count as movement. Movement should be based on size as well.
+    A single frame of major movement might be enough to trigger the start
+    of movement, or several frames of small movement.
+    Consider categorising movement (small, medium, large)?
+    """
+
+    def __init__(self, fps: int):
+        self.max_motion = fps * MAX_MOTION_SECONDS
+        self.recent_motion = 0
+
+    def update(self, motion_area: tuple, frames: int = 1) -> str:
+        """
+        Track the motion in a frame. Returns MOTION_STARTED, MOTION_CONTINUING
+        or MOTION_STOPPED, or None if there's still no motion.
+
+        If only every few frames are analysed, "frames" is how many frames
+        this motion_area stands for.
+        """
+        if not motion_area or motion_area == (0, 0, 0, 0):
+            # No motion detected
+            stopped = 0 < self.recent_motion <= frames
+            self.recent_motion = max(0, self.recent_motion - frames)
+            return MOTION_STOPPED if stopped else None
+
+        if self.recent_motion == 0:
+            # New motion detected
+            self.recent_motion = self.max_motion
+            return MOTION_STARTED
+
+        # Motion is continuing
+        self.recent_motion = min(self.recent_motion + MAX_MOTION_SECONDS * frames, self.max_motion)
+        return MOTION_CONTINUING
@@ -0,0 +1,154 @@
+"""
+Motion Vectors
+
+H.264 cameras have already worked out how each block of the picture moved,
+to compress it. This reads those motion vectors out of the stream (with
+ffmpeg's "+export_mvs" flag, through PyAV), and turns them into a coarse grid
+of motion. Detecting motion from that grid is far cheaper than comparing
+pixels (absdiff, threshold, dilate, findContours).
+
+The frames still have to be decoded to get at the vectors, but nothing is
+done with the pixels unless they're needed for recording.
+
+Requires PyAV (`pip install av`).
+"""
+
+import cv2
+import logging
+import numpy as np
+
+try:
+    import av
+except ImportError:
+    av = None
+
+
+def motion_grid(vectors: np.ndarray, width: int, height: int, cell: int = 16) -> np.ndarray:
+    """
+    Work out the average motion (in pixels) of each cell x cell block of the
+    frame, from a structured array of AVMotionVectors.
+    """
+    rows, cols = -(-height // cell), -(-width // cell)
+    total = np.zeros((rows, cols), dtype=np.float32)
+    count = np.zeros((rows, cols), dtype=np.float32)
+    if vectors is None or len(vectors) == 0:
+        return total
+
+    magnitude = np.hypot(vectors["motion_x"], vectors["motion_y"]) / np.maximum(vectors["motion_scale"], 1)
+    row = np.clip(vectors["dst_y"] // cell, 0, rows - 1)
+    col = np.clip(vectors["dst_x"] // cell, 0, cols - 1)
+    np.add.at(total, (row, col), magnitude)
+    np.add.at(count, (row, col), 1)
+
+    return np.divide(total, count, out=total, where=count > 0)
+
+
+class MotionVectorDetector():
+    """
+    Finds the largest area of motion in a frame's motion vectors.
+
+    If there's a mask (the size of the frame), cells that are mostly masked
+    out are ignored.
+    """
+
+    def __init__(self, width: int, height: int, cell: int = 16, min_cells: int = 2, mask: np.ndarray = None):
+        self.width = width
+        self.height = height
+        self.cell = cell
+        self.min_cells = min_cells
+        self.grid_mask = None
+        if mask is not None:
+            rows, cols = -(-height // cell), -(-width // cell)
+            self.grid_mask = cv2.resize(mask, (cols, rows), interpolation=cv2.INTER_AREA) >= 128
+
+    def detect(self, vectors: np.ndarray, sensitive: bool) -> tuple:
+        """
+        Return a box around the largest area of motion, in frame coordinates.
+        """
+        grid = motion_grid(vectors, self.width, self.height, self.cell)
+
+        # Average movement (in pixels) for a block to count as moving
+        threshold = 0.5 if sensitive else 1.5
+        moving = grid > threshold
+        if self.grid_mask is not None:
+            moving &= self.grid_mask
+        moving = moving.astype(np.uint8)
+
+        # The grid is tiny (e.g: 120x68 for 1080p), so this is cheap
+        count, _, stats, _ = cv2.connectedComponentsWithStats(moving, connectivity=8)
+        largest_motion = (0, 0, 0, 0)
+        for x, y, w, h, area in stats[1:count]:
+            if area < self.min_cells:
+                continue
+            if w * h > largest_motion[2] * largest_motion[3]:
+                largest_motion = (int(x), int(y), int(w), int(h))
+
+        x, y, w, h = (v * self.cell for v in largest_motion)
+        return (x, y, min(w, self.width - x), min(h, self.height - y))
+
+
+class MotionVectorCapture():
+    """
+    Implements the parts of `cv2.VideoCapture` that StreamWatch uses, and
+    keeps the motion vectors of the last frame read in `side_data`.
+
+    If "decode_pixels" is False, the BGR frame isn't produced at all. A blank
+    frame is returned instead, for when only motion detection is needed.
+    """
+
+    def __init__(self, url: str, decode_pixels: bool = True):
+        if av is None:
+            raise SystemExit("Motion vector detection requires PyAV. Install it with 'pip install av'.")
+
+        options = {"rtsp_transport": "tcp"} if url.startswith("rtsp://") else {}
+        self.container = av.open(url, options=options)
+        self.stream = self.container.streams.video[0]
+        self.stream.thread_type = "AUTO"
+        self.stream.codec_context.options = {"flags2": "+export_mvs"}
+
+        self.decode_pixels = decode_pixels
+        self.width = self.stream.codec_context.width
+        self.height = self.stream.codec_context.height
+        self.fps = float(self.stream.average_rate or self.stream.guessed_rate or 25)
+        self.frames_read = 0
+        self.side_data = None
+        self._blank = None
+        self._frames = self.container.decode(self.stream)
+        self._open = True
+
+    def isOpened(self) -> bool:
+        return self._open
+
+    def read(self) -> tuple:
+        try:
+            frame = next(self._frames)
+        except (StopIteration, av.error.FFmpegError) as e:
+            logging.warning(f"Motion vector stream ended: {e or 'end of stream'}")
+            self._open = False
+            return False, None
+
+        self.frames_read += 1
+        vectors = frame.side_data.get("MOTION_VECTORS")
+        # Keyframes have no motion vectors
+        self.side_data = vectors.to_ndarray() if vectors is not None else None
+
+        if self.decode_pixels:
+            return True, frame.to_ndarray(format="bgr24")
+        if self._blank is None:
+            self._blank = np.zeros((self.height, self.width, 3), dtype=np.uint8)
+        return True, self._blank
+
+    def get(self, prop: int) -> float:
+        if prop == cv2.CAP_PROP_FPS:
+            return self.fps
+        if prop == cv2.CAP_PROP_FRAME_WIDTH:
+            return self.width
+        if prop == cv2.CAP_PROP_FRAME_HEIGHT:
+            return self.height
+        if prop == cv2.CAP_PROP_POS_FRAMES:
+            return self.frames_read
+        return 0
+
+    def release(self) -> None:
+        self._open = False
+        self.container.close()
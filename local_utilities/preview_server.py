@@ -0,0 +1,179 @@
+"""
+Preview Server
+
+Serves a live preview of a stream over HTTP, so it can be watched from a
+browser without a display attached:
+ - http://<host>:<port>/ - A page showing the stream.
+ - http://<host>:<port>/stream.mjpg - An MJPEG stream.
+ - http://<host>:<port>/snapshot.jpg - The latest frame.
+
+Previews are shrunk and limited to a few FPS. Each preview frame is encoded
+to JPEG once, and the same bytes are sent to every viewer. While nobody is
+watching, `wants_frame()` is False, so nothing is shrunk or encoded at all.
+
+There's no authentication, so it's only served to this machine unless
+another host (e.g: "0.0.0.0") is given.
+"""
+
+import cv2
+import time
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from numpy import empty, uint8
+
+BOUNDARY = "frame"
+PAGE = b"<html><body style='margin:0;background:#000'><img src='/stream.mjpg' style='max-width:100%'></body></html>"
+
+
+class PreviewServer():
+    def __init__(self, port: int, host: str = "127.0.0.1", width: int = 640, fps: float = 5, quality: int = 70):
+        self.width = width
+        self.interval = 1 / max(fps, 0.1)
+        self.params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+
+        self._condition = threading.Condition()
+        self._jpeg = None
+        self._sequence = 0
+        self._last_published = 0
+        self._buffer = None
+        self._snapshot_wanted = False
+        self.scale = 1
+
+        # Metrics
+        self.viewers = 0
+        self.frames_encoded = 0
+        self.bytes_sent = 0
+
+        preview = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/":
+                    self.send_body(PAGE, "text/html")
+                elif self.path == "/snapshot.jpg":
+                    jpeg = preview.snapshot()
+                    if jpeg is None:
+                        self.send_error(503, "No frames yet")
+                        return
+                    self.send_body(jpeg, "image/jpeg")
+                elif self.path == "/stream.mjpg":
+                    self.stream()
+                else:
+                    self.send_error(404)
+
+            def send_body(self, body: bytes, content_type: str):
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                preview.bytes_sent += len(body)
+
+            def stream(self):
+                self.send_response(200)
+                self.send_header("Content-Type", f"multipart/x-mixed-replace; boundary={BOUNDARY}")
+                self.send_header("Cache-Control", "no-cache")
+                self.end_headers()
+                with preview._condition:
+                    preview.viewers += 1
+                try:
+                    sequence = 0
+                    while True:
+                        sequence, jpeg = preview.next_frame(sequence)
+                        if jpeg is None:
+                            continue
+                        self.wfile.write(
+                            f"--{BOUNDARY}\r\nContent-Type: image/jpeg\r\nContent-Length: {len(jpeg)}\r\n\r\n".encode()
+                            + jpeg + b"\r\n"
+                        )
+                        preview.bytes_sent += len(jpeg)
+                except (BrokenPipeError, ConnectionResetError):
+                    pass
+                finally:
+                    with preview._condition:
+                        preview.viewers -= 1
+
+            def log_message(self, format, *args):
+                # Don't log every frame
+                pass
+
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="preview-server", daemon=True)
+        self.thread.start()
+        logging.info(f"Serving a live preview at http://{host}:{port}/.")
+
+    def wants_frame(self) -> bool:
+        """
+        Whether anyone is waiting for a new preview frame (and it's time for one).
+        """
+        if not self.viewers and not self._snapshot_wanted:
+            return False
+        return time.monotonic() - self._last_published >= self.interval
+
+    def shrink(self, frame):
+        """
+        Shrink a frame into a reused buffer, which is safe to draw on. The
+        factor it was shrunk by is in `scale`.
+        """
+        height, width = frame.shape[:2]
+        if width <= self.width:
+            shape = frame.shape
+        else:
+            shape = (round(height * self.width / width), self.width, *frame.shape[2:])
+        if self._buffer is None or self._buffer.shape != shape:
+            self._buffer = empty(shape, dtype=uint8)
+
+        self.scale = shape[1] / width
+        if shape == frame.shape:
+            self._buffer[:] = frame
+        else:
+            cv2.resize(frame, (shape[1], shape[0]), dst=self._buffer, interpolation=cv2.INTER_AREA)
+        return self._buffer
+
+    def publish(self, image) -> None:
+        """
+        Encode a preview frame once, and hand it to every viewer.
+        """
+        self._last_published = time.monotonic()
+        ok, encoded = cv2.imencode(".jpg", image, self.params)
+        if not ok:
+            logging.warning("Failed to encode a preview frame.")
+            return
+
+        with self._condition:
+            self._jpeg = encoded.tobytes()
+            self._sequence += 1
+            self._snapshot_wanted = False
+            self.frames_encoded += 1
+            self._condition.notify_all()
+
+    def next_frame(self, sequence: int, timeout: float = 5) -> tuple:
+        """
+        Wait for a frame newer than "sequence". Returns its sequence and JPEG.
+        """
+        with self._condition:
+            self._condition.wait_for(lambda: self._sequence != sequence, timeout=timeout)
+            return self._sequence, self._jpeg if self._sequence != sequence else None
+
+    def snapshot(self, timeout: float = 2) -> bytes:
+        """
+        Ask for a fresh frame, and wait for it. Falls back to the last one.
+        """
+        with self._condition:
+            sequence = self._sequence
+            self._snapshot_wanted = True
+            self._condition.wait_for(lambda: self._sequence != sequence, timeout=timeout)
+            return self._jpeg
+
+    def stats(self) -> dict:
+        return {
+            "viewers": self.viewers,
+            "frames_encoded": self.frames_encoded,
+            "bytes_sent": self.bytes_sent,
+        }
+
+    def close(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
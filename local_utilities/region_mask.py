@@ -0,0 +1,98 @@
+"""
+Region Mask
+
+Limits motion detection to the parts of the frame we care about. A mask is
+made of polygons to include (e.g: the driveway) and polygons to exclude
+(e.g: a tree that blows around, or the road). It's configured per camera:
+
+"mask": {
+    "size": [1920, 1080],
+    "include": [[[100, 400], [1800, 400], [1800, 1080], [100, 1080]]],
+    "exclude": [[[900, 400], [1200, 400], [1200, 600], [900, 600]]]
+}
+
+Points are in pixels of an image "size" wide and high (e.g: a snapshot the
+polygons were measured on), and are scaled to fit the stream. Without
+"size", they're taken to be in the stream's own pixels. Without any
+"include" polygons, the whole frame is included.
+
+The polygons are rasterised once. Analysis is cropped to the bounding box
+of the included area, so nothing outside it is blurred or compared at all.
+"""
+
+import cv2
+import imutils
+from numpy import array, zeros, full, int32, uint8
+
+
+class RegionMask():
+    def __init__(self, config: dict, width: int, height: int):
+        self.width = width
+        self.height = height
+
+        size = config.get("size") or (width, height)
+        scale = (width / size[0], height / size[1])
+        include = [self._polygon(points, scale) for points in config.get("include", [])]
+        exclude = [self._polygon(points, scale) for points in config.get("exclude", [])]
+
+        if include:
+            self.mask = zeros((height, width), dtype=uint8)
+            cv2.fillPoly(self.mask, include, 255)
+        else:
+            self.mask = full((height, width), 255, dtype=uint8)
+        if exclude:
+            cv2.fillPoly(self.mask, exclude, 0)
+
+        if not self.mask.any():
+            raise ValueError("The region mask excludes the whole frame.")
+
+        # The bounding box of everything that's included, as (x, y, w, h)
+        self.box = cv2.boundingRect(self.mask)
+        x, y, w, h = self.box
+        self.area = int((self.mask > 0).sum())
+        # The mask cropped to the box, and resized for each analysis size
+        self._cropped = self.mask[y:y + h, x:x + w]
+        self._resized = {}
+        # The outlines of the included areas, for drawing on debug frames
+        self.outlines = imutils.grab_contours(cv2.findContours(self.mask, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE))
+
+    @staticmethod
+    def _polygon(points: list, scale: tuple):
+        return array([(x * scale[0], y * scale[1]) for x, y in points]).round().astype(int32)
+
+    def crop(self, frame):
+        """
+        Crop a full frame to the bounding box of the mask. This is a view,
+        not a copy.
+        """
+        x, y, w, h = self.box
+        return frame[y:y + h, x:x + w]
+
+    def crop_width(self, width: int) -> int:
+        """
+        The width to shrink a cropped frame to, so that it's shrunk as much
+        as a full frame would be at this width.
+        """
+        if not width:
+            return width
+        return max(round(width * self.box[2] / self.width), 1)
+
+    def mask_for(self, shape: tuple):
+        """
+        The mask for a cropped (and maybe shrunk) frame of this shape.
+        """
+        shape = shape[:2]
+        if shape not in self._resized:
+            if shape == self._cropped.shape:
+                self._resized[shape] = self._cropped
+            else:
+                self._resized[shape] = cv2.resize(self._cropped, (shape[1], shape[0]), interpolation=cv2.INTER_NEAREST)
+        return self._resized[shape]
+
+    def to_frame(self, box: tuple) -> tuple:
+        """
+        Map an (x, y, w, h) box from the cropped frame back to the full frame.
+        """
+        if box == (0, 0, 0, 0):
+            return box
+        return (box[0] + self.box[0], box[1] + self.box[1], box[2], box[3])
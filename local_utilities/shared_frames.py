@@ -0,0 +1,141 @@
+"""
+Shared Frames
+
+A transport for sending frames to another process, without pickling them.
+
+Frames are copied once into a preallocated ring of slots in shared memory. Only
+the (sequence, slot) index is sent through a pipe. The consumer maps the slot
+as a numpy view, so it never copies the frame at all.
+
+Each ring has exactly one producer and one consumer. The consumer must be
+started with the ring as an argument (e.g: `Process(target=f, args=(ring,))`)
+so that the semaphore and pipe are inherited.
+
+Backpressure: a slot is only reused once the consumer has released it. If
+no slot is free within `timeout` seconds, the frame is dropped and counted.
+"""
+
+import os
+import logging
+import numpy as np
+from multiprocessing import Pipe, Semaphore, Value
+from multiprocessing.shared_memory import SharedMemory
+
+
+class SharedFrameRing():
+    def __init__(self, shape: tuple, dtype=np.uint8, slots: int = 4, timeout: float = 0):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.slots = max(slots, 1)
+        self.timeout = timeout
+        self.slot_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+
+        self._shm = SharedMemory(create=True, size=self.slot_bytes * self.slots)
+        self._free = Semaphore(self.slots)
+        self._index_out, self._index_in = Pipe(duplex=False)
+        self._dropped = Value("Q", 0, lock=False)
+        self._map_slots()
+
+        # Whichever process created the ring is the producer
+        self._producer_pid = os.getpid()
+
+        # Producer-side state
+        self.sent = 0
+        # Consumer-side state
+        self._held = None
+        self.closed = False
+
+    @property
+    def dropped(self) -> int:
+        return self._dropped.value
+
+    def _map_slots(self) -> None:
+        buffer = np.ndarray((self.slots, *self.shape), dtype=self.dtype, buffer=self._shm.buf)
+        self._frames = [buffer[i] for i in range(self.slots)]
+
+    def __getstate__(self):
+        # Numpy views can't be pickled. The consumer maps them again by name.
+        state = self.__dict__.copy()
+        del state["_frames"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._map_slots()
+
+    def send(self, frame: np.ndarray) -> bool:
+        """
+        Copy a frame into the next free slot, and tell the consumer about it.
+
+        Returns False if the frame was dropped.
+        """
+        if frame.shape != self.shape:
+            logging.warning(f"Frame shape {frame.shape} does not fit shared ring {self.shape}. Dropping.")
+            self._dropped.value += 1
+            return False
+
+        if not self._free.acquire(timeout=self.timeout):
+            # The consumer is too far behind
+            self._dropped.value += 1
+            return False
+
+        # Slots are always consumed and released in order
+        slot = self.sent % self.slots
+        np.copyto(self._frames[slot], frame)
+        self._index_in.send((self.sent, slot))
+        self.sent += 1
+        return True
+
+    def recv(self) -> np.ndarray:
+        """
+        Wait for the next frame, and return a read-only view of its slot.
+
+        The view is only valid until the next call to `recv()` or `release()`.
+        Raises EOFError once the producer has closed the ring.
+        """
+        self.release()
+        message = self._index_out.recv()
+        if message is None:
+            raise EOFError("Shared frame ring was closed by the producer.")
+
+        _, slot = message
+        self._held = slot
+        view = self._frames[slot].view()
+        view.flags.writeable = False
+        return view
+
+    def release(self) -> None:
+        """
+        Give the slot from the last `recv()` back to the producer.
+        """
+        if self._held is not None:
+            self._held = None
+            self._free.release()
+
+    def close(self) -> None:
+        """
+        Producer: tell the consumer there are no more frames.
+        Consumer: stop using the shared memory.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if os.getpid() == self._producer_pid:
+            try:
+                self._index_in.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        self.release()
+        self._frames = []
+        try:
+            self._shm.close()
+        except BufferError:
+            # A view from recv() is still alive. It is freed when the process exits.
+            logging.debug("Shared frame ring closed while a frame view was still in use.")
+
+    def unlink(self) -> None:
+        """
+        Free the shared memory. Only the producer should do this, once the
+        consumer has finished.
+        """
+        self._shm.unlink()
@@ -0,0 +1,185 @@
+"""
+Snapshot Writer
+
+Saves frames as image files without holding up the caller. Frames are
+encoded (with `cv2.imencode`) on a pool of worker threads, and the encoded
+bytes are written to disk by a separate I/O thread, so a slow SD card only
+ever stalls that thread.
+
+Files are laid out as "<directory>/<YYYY-MM-DD>/<HH>/<name>.<format>", so no
+single directory ends up with hundreds of thousands of files.
+
+At most "queue_size" frames are waiting at once. Beyond that, frames are
+dropped (and counted) rather than using up all of the RAM.
+
+With "dedupe_threshold", frames of an unchanged scene aren't saved at all.
+Each frame's perceptual hash (see `image_utils.difference_hash`) is compared
+to the last saved frame's, and it's only saved if they differ by more than
+that many bits (out of 64), if there's motion, or if nothing has been saved
+for "keepalive_seconds".
+"""
+
+import os
+import cv2
+import time
+import queue
+import logging
+import threading
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+from local_utilities.image_utils import difference_hash, hamming_distance
+
+FORMATS = ("jpg", "webp", "png")
+
+
+def encode_params(extension: str, quality: int) -> list:
+    if extension == "jpg":
+        return [cv2.IMWRITE_JPEG_QUALITY, quality]
+    if extension == "webp":
+        return [cv2.IMWRITE_WEBP_QUALITY, quality]
+    # PNG is lossless, so there's no quality. Favour speed over size.
+    return [cv2.IMWRITE_PNG_COMPRESSION, 1]
+
+
+class SnapshotWriter():
+    def __init__(self,
+                 directory: str,
+                 quality: int = 90,
+                 extension: str = "jpg",
+                 workers: int = 2,
+                 queue_size: int = 32,
+                 dedupe_threshold: int = None,
+                 keepalive_seconds: int = 300,
+                ):
+        if extension not in FORMATS:
+            raise ValueError(f"Unknown image format '{extension}'. Expected one of {FORMATS}.")
+
+        self.directory = directory
+        self.extension = extension
+        self.params = encode_params(extension, quality)
+        self.dedupe_threshold = dedupe_threshold
+        self.keepalive_seconds = keepalive_seconds
+
+        self._last_hash = None
+        self._last_saved = 0
+
+        self._slots = threading.BoundedSemaphore(max(queue_size, 1))
+        self._pool = ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix="snapshot-encoder")
+        self._io_queue = queue.Queue()
+        self._made_dirs = set()
+        self._io_thread = threading.Thread(target=self._write_files, name="snapshot-writer", daemon=True)
+        self._io_thread.start()
+
+        # Metrics
+        self.saved = 0
+        self.dropped = 0
+        self.duplicates = 0
+        self.failed = 0
+        self.bytes_written = 0
+        self.encode_seconds = 0
+        self.write_seconds = 0
+
+    def save(self, frame, name: str, motion: bool = False) -> bool:
+        """
+        Queue a frame to be saved. Returns False if it had to be dropped.
+        The frame must not be modified afterwards.
+
+        Duplicate frames are skipped, but that isn't a failure, so it
+        returns True.
+        """
+        frame_hash = None
+        if self.dedupe_threshold is not None:
+            frame_hash = difference_hash(frame)
+            if self.is_duplicate(frame_hash, motion):
+                self.duplicates += 1
+                return True
+
+        if not self._slots.acquire(blocking=False):
+            self.dropped += 1
+            return False
+
+        # Work out the path now, so it reflects when the frame was captured
+        subdirectory = datetime.now().strftime("%Y-%m-%d/%H")
+        path = f"{self.directory}/{subdirectory}/{name}.{self.extension}"
+        self._pool.submit(self._encode, frame, path)
+
+        # Only a frame that's actually queued is compared against, otherwise
+        # a dropped frame would cause the next ones to be skipped as well
+        if frame_hash is not None:
+            self._last_hash = frame_hash
+            self._last_saved = time.monotonic()
+        return True
+
+    def is_duplicate(self, frame_hash: int, motion: bool = False) -> bool:
+        """
+        Whether a frame (by its `difference_hash`) looks the same as the last
+        one that was saved, recently enough. Frames with motion never are.
+        """
+        return (not motion
+                and self._last_hash is not None
+                and time.monotonic() - self._last_saved < self.keepalive_seconds
+                and hamming_distance(frame_hash, self._last_hash) <= self.dedupe_threshold)
+
+    def bytes_avoided(self) -> int:
+        """
+        Roughly how many bytes the skipped duplicates would have taken up,
+        going by the size of the images that were saved.
+        """
+        return round(self.duplicates * self.bytes_written / max(self.saved, 1))
+
+    def close(self) -> None:
+        """
+        Save everything that's queued, and stop the threads.
+        """
+        self._pool.shutdown(wait=True)
+        self._io_queue.put(None)
+        self._io_thread.join()
+
+    def stats(self) -> dict:
+        return {
+            "saved": self.saved,
+            "dropped": self.dropped,
+            "duplicates": self.duplicates,
+            "failed": self.failed,
+            "bytes_written": self.bytes_written,
+            "bytes_avoided": self.bytes_avoided(),
+            "mean_encode_ms": round(1000 * self.encode_seconds / max(self.saved, 1), 2),
+            "mean_write_ms": round(1000 * self.write_seconds / max(self.saved, 1), 2),
+        }
+
+    def _encode(self, frame, path: str) -> None:
+        start = time.perf_counter()
+        ok, encoded = cv2.imencode(f".{self.extension}", frame, self.params)
+        self.encode_seconds += time.perf_counter() - start
+
+        if not ok:
+            logging.warning(f"Failed to encode '{path}'.")
+            self.failed += 1
+            self._slots.release()
+            return
+        self._io_queue.put((path, encoded))
+
+    def _write_files(self) -> None:
+        while True:
+            item = self._io_queue.get()
+            if item is None:
+                return
+
+            path, encoded = item
+            start = time.perf_counter()
+            try:
+                directory = os.path.dirname(path)
+                if directory not in self._made_dirs:
+                    os.makedirs(directory, exist_ok=True)
+                    self._made_dirs.add(directory)
+                with open(path, "wb") as f:
+                    f.write(encoded)
+                self.saved += 1
+                self.bytes_written += len(encoded)
+            except OSError as e:
+                logging.warning(f"Failed to write '{path}': {e}")
+                self.failed += 1
+            finally:
+                self.write_seconds += time.perf_counter() - start
+                self._slots.release()
@@ -0,0 +1,326 @@
+"""
+Stream Recorder
+
+Records a stream without decoding or re-encoding it. A local ffmpeg copies
+the camera's compressed packets (e.g: H.264) straight into MKV/MP4 files
+(`-c copy`), which costs almost no CPU, and loses no quality.
+
+Continuous recording is ffmpeg's segment muxer, writing files named by the
+time they start, split every "segment_seconds".
+
+Motion recording can only cut the stream at keyframes. ffmpeg writes the
+stream as short chunks (one or more GOPs each) into a spool directory, and
+the chunks from around each motion event are joined (again without
+re-encoding) into one file. Chunks from before the pre-roll are deleted.
+This means events start and stop on keyframes, at or beyond the pre-roll
+and post-roll.
+
+Either way, ffmpeg lists each file as it's finished, so `mark()` can find out
+which file (and how far into it) a point in the stream was recorded to.
+"""
+
+import os
+import time
+import logging
+import threading
+import subprocess
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from local_utilities.backoff import Backoff, MAX_BACKOFF
+
+RECORD_BACKENDS = ("opencv", "copy")
+FORMATS = ("mkv", "mp4")
+
+# A chunk of the spooled stream, and when it started and ended (wall time)
+Chunk = namedtuple("Chunk", ["path", "start", "end"])
+
+
+class StreamCopyRecorder():
+    def __init__(self,
+                 url: str,
+                 directory: str,
+                 prefix: str = "",
+                 extension: str = "mkv",
+                 motion: bool = False,
+                 segment_seconds: int = 3600,
+                 chunk_seconds: int = 2,
+                 pre_roll: int = 5,
+                 post_roll: int = 5,
+                 ffmpeg: str = "ffmpeg",
+                ):
+        if extension not in FORMATS:
+            raise ValueError(f"Unknown video format '{extension}'. Expected one of {FORMATS}.")
+
+        self.url = url
+        self.directory = directory
+        self.prefix = prefix
+        self.extension = extension
+        self.motion = motion
+        self.segment_seconds = segment_seconds or 3600
+        self.chunk_seconds = chunk_seconds
+        self.pre_roll = pre_roll
+        self.post_roll = post_roll
+        self.ffmpeg = ffmpeg
+        self.spool = f"{directory}/.spool"
+        self.segment_list = f"{self.spool}/chunks.csv"
+
+        self._lock = threading.Lock()
+        self._chunks = deque()
+        self._event_start = None
+        self._event_stop = None
+        self._stopping = threading.Event()
+        self._process = None
+        # (time, callback) for each `mark()` that hasn't been recorded yet
+        self._marks = []
+        # Chunk numbers carry on across restarts, so chunks aren't overwritten
+        self._chunk_number = 0
+        # Events are joined here, so the lock is never held while ffmpeg runs
+        self._saver = ThreadPoolExecutor(max_workers=1, thread_name_prefix="stream-recorder-save")
+
+        # Metrics
+        self.events_saved = 0
+        self.chunks_deleted = 0
+        self.restarts = 0
+
+        # The spool also holds the segment list, when recording continuously
+        os.makedirs(self.spool, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="stream-recorder", daemon=True)
+        self._thread.start()
+
+    def _command(self) -> list:
+        command = [self.ffmpeg, "-hide_banner", "-loglevel", "error", "-nostdin"]
+        if self.url.startswith("rtsp://"):
+            command += ["-rtsp_transport", "tcp"]
+        command += ["-i", self.url, "-map", "0:v", "-c", "copy", "-f", "segment", "-reset_timestamps", "1"]
+        command += ["-segment_list", self.segment_list, "-segment_list_type", "csv"]
+
+        if self.motion:
+            # Segments can only be cut at keyframes, so chunks are at least a GOP
+            command += [
+                "-segment_time", str(self.chunk_seconds), "-segment_start_number", str(self._chunk_number),
+                f"{self.spool}/%06d.{self.extension}",
+            ]
+        else:
+            command += [
+                "-segment_time", str(self.segment_seconds), "-strftime", "1",
+                f"{self.directory}/{self.prefix}%Y-%m-%d_%H-%M-%S.{self.extension}",
+            ]
+        return command
+
+    def start_motion(self) -> None:
+        """
+        Motion has started. Everything from the pre-roll onwards is kept.
+        """
+        with self._lock:
+            if self._event_start is None:
+                self._event_start = time.time()
+            self._event_stop = None
+
+    def stop_motion(self) -> None:
+        """
+        Motion has stopped. The event is saved once the post-roll is spooled.
+        """
+        with self._lock:
+            if self._event_start is not None:
+                self._event_stop = time.time()
+
+    def mark(self, callback) -> None:
+        """
+        Call "callback(filename, seconds)" once the file that this point in
+        the stream is being recorded to has been saved, with how many seconds
+        into the file it is. When recording motion, this should be during an
+        event. Both are None if it wasn't recorded.
+        """
+        with self._lock:
+            self._marks.append((time.time(), callback))
+
+    def release(self) -> None:
+        """
+        Stop ffmpeg, and save any event that's in progress (waiting for it,
+        and any other events still being saved).
+        """
+        # ffmpeg is started under the lock, so it's either running, or won't be
+        with self._lock:
+            self._stopping.set()
+            if self._process is not None and self._process.poll() is None:
+                # ffmpeg finishes the current file cleanly on SIGTERM
+                self._process.terminate()
+        self._thread.join()
+        self._saver.shutdown(wait=True)
+
+        # Nothing else will be recorded
+        for _, callback in self._marks:
+            callback(None, None)
+        self._marks.clear()
+
+    def stats(self) -> dict:
+        return {
+            "events_saved": self.events_saved,
+            "chunks_spooled": len(self._chunks),
+            "chunks_deleted": self.chunks_deleted,
+            "restarts": self.restarts,
+        }
+
+    def _run(self) -> None:
+        backoff = Backoff()
+        while True:
+            with self._lock:
+                if self._stopping.is_set():
+                    break
+                if os.path.exists(self.segment_list):
+                    os.remove(self.segment_list)
+
+                command = self._command()
+                logging.debug(f"Starting ffmpeg: {' '.join(command)}")
+                started = time.monotonic()
+                self._process = subprocess.Popen(command, stdin=subprocess.DEVNULL)
+
+            self._follow_chunks()
+            self._process.wait()
+
+            if self._stopping.is_set():
+                break
+            if time.monotonic() - started > MAX_BACKOFF:
+                # It ran for a while, so this isn't a failure to start
+                backoff.reset()
+            logging.warning(f"Stream-copy ffmpeg exited with code {self._process.returncode}. Restarting in about {backoff.delay}s.")
+            if self._stopping.wait(backoff.next()):
+                break
+            self.restarts += 1
+
+        if self.motion:
+            with self._lock:
+                if self._event_start is not None:
+                    self._event_stop = self._event_stop or time.time()
+                    self._save_event(force=True)
+            self._prune(time.time())
+
+    def _follow_chunks(self) -> None:
+        """
+        Read each chunk from ffmpeg's segment list as it's finished.
+        """
+        while not os.path.exists(self.segment_list):
+            if self._process.poll() is not None:
+                return
+            time.sleep(0.2)
+
+        with open(self.segment_list, "r") as segment_list:
+            while True:
+                # Check first, so the last lines are read after ffmpeg exits
+                exited = self._process.poll() is not None
+                position = segment_list.tell()
+                line = segment_list.readline()
+                if not line.endswith("\n"):
+                    if exited:
+                        return
+                    # Wait for the rest of the line
+                    segment_list.seek(position)
+                    time.sleep(0.2)
+                    continue
+
+                # "<file>,<start>,<end>", in seconds since the stream started
+                name, start, end = line.strip().rsplit(",", 2)
+                finished = time.time()
+                if not self.motion:
+                    segment = Chunk(f"{self.directory}/{name}", finished - (float(end) - float(start)), finished)
+                    self._segment_finished(segment)
+                    continue
+
+                chunk = Chunk(f"{self.spool}/{name}", finished - (float(end) - float(start)), finished)
+                self._chunk_number += 1
+                with self._lock:
+                    self._chunks.append(chunk)
+                    self._save_event()
+                    if self._event_start is None:
+                        self._prune(finished)
+
+    def _segment_finished(self, segment: Chunk) -> None:
+        """
+        Tell the marks that were made during a continuous segment where they are.
+        """
+        with self._lock:
+            marks = [mark for mark in self._marks if mark[0] <= segment.end]
+            self._marks = [mark for mark in self._marks if mark[0] > segment.end]
+        for timestamp, callback in marks:
+            # Anything marked while ffmpeg was restarting is at the start
+            callback(segment.path, max(timestamp - segment.start, 0))
+
+    def _prune(self, now: float) -> None:
+        # Keep enough chunks to cover the pre-roll
+        while self._chunks and self._chunks[0].end < now - self.pre_roll:
+            self._delete(self._chunks.popleft())
+
+    def _delete(self, chunk: Chunk) -> None:
+        try:
+            os.remove(chunk.path)
+            self.chunks_deleted += 1
+        except OSError as e:
+            logging.warning(f"Failed to delete '{chunk.path}': {e}")
+
+    def _save_event(self, force: bool = False) -> None:
+        """
+        Take the chunks of a finished event, and join them into one file in
+        the background. Must hold the lock.
+        """
+        if self._event_stop is None or not self._chunks:
+            return
+        if not force and self._chunks[-1].end < self._event_stop + self.post_roll:
+            # The post-roll hasn't been spooled yet
+            return
+
+        start = self._event_start - self.pre_roll
+        while self._chunks and self._chunks[0].end < start:
+            self._delete(self._chunks.popleft())
+        chunks = list(self._chunks)
+        self._chunks.clear()
+        name = datetime.fromtimestamp(self._event_start).strftime("%Y-%m-%d_%H-%M-%S")
+        self._event_start = self._event_stop = None
+        # Everything marked since the last event was saved is part of this one
+        marks, self._marks = self._marks, []
+        if not chunks:
+            for _, callback in marks:
+                callback(None, None)
+            return
+        self._saver.submit(self._join_chunks, chunks, name, marks)
+
+    def _join_chunks(self, chunks: list, name: str, marks: list) -> None:
+        """
+        Join the chunks into one file (without re-encoding), then delete them.
+        Then tell the marks where they are in it.
+        """
+        output = self._join(chunks, name)
+        for timestamp, callback in marks:
+            if output is None:
+                callback(None, None)
+            else:
+                callback(output, max(timestamp - chunks[0].start, 0))
+
+    def _join(self, chunks: list, name: str) -> str:
+        """
+        Returns the joined file, or None if it couldn't be saved.
+        """
+        output = f"{self.directory}/{self.prefix}{name}.{self.extension}"
+        concat_list = f"{self.spool}/{name}.txt"
+        try:
+            with open(concat_list, "w") as f:
+                f.writelines(f"file '{os.path.abspath(chunk.path)}'\n" for chunk in chunks)
+            result = subprocess.run(
+                [self.ffmpeg, "-hide_banner", "-loglevel", "error", "-nostdin", "-y",
+                 "-f", "concat", "-safe", "0", "-i", concat_list, "-c", "copy", output],
+                capture_output=True,
+            )
+        except OSError as e:
+            # Nothing else would report it, from the worker thread
+            logging.warning(f"Failed to save motion to '{output}' (the chunks are left in '{self.spool}'): {e}")
+            return None
+        if result.returncode != 0:
+            logging.warning(f"Failed to save motion to '{output}' (the chunks are left in '{self.spool}'): {result.stderr.decode().strip()}")
+            return None
+        logging.info(f"Saved motion to '{output}' ({len(chunks)} chunks).")
+        self.events_saved += 1
+        for chunk in chunks:
+            self._delete(chunk)
+        os.remove(concat_list)
+        return output
@@ -0,0 +1,330 @@
+"""
+Video Utilities
+
+Helpers for recording video from a stream.
+"""
+
+import os
+import cv2
+import time
+import queue
+import logging
+import pathlib
+import threading
+from collections import deque
+from datetime import datetime
+from numpy import ndarray as np_image, empty, frombuffer, uint8
+
+# Markers that can be queued in place of a frame
+_SPLIT = object()
+_STOP = object()
+
+
+class _Frames():
+    """
+    Queued by `BackgroundVideoWriter.write_all()`, for several frames that
+    are written together (and only read on the encoder thread).
+    """
+    __slots__ = ("frames",)
+
+    def __init__(self, frames):
+        self.frames = frames
+
+# The JPEG quality to fall back on when raw frames would use too much RAM
+FALLBACK_JPEG_QUALITY = 85
+
+
+class _Mark():
+    """
+    Queued by `BackgroundVideoWriter.mark()`, to find out where a point in
+    the stream ends up in the video files.
+    """
+    __slots__ = ("callback", "before_next")
+
+    def __init__(self, callback, before_next: bool):
+        self.callback = callback
+        self.before_next = before_next
+
+
+class PreRollBuffer():
+    """
+    Keeps the last "size" frames, so that a recording can start a few seconds
+    before the event that triggered it.
+
+    Raw frames are copied into a single preallocated array. If a JPEG quality
+    is given, frames are compressed instead, which uses far less RAM (at the
+    cost of some CPU, and a little quality).
+
+    Raw frames add up quickly (5 seconds of 1080p at 25 FPS is about 780MB),
+    so if they'd take more than "max_bytes", frames are compressed anyway.
+    While a taken pre-roll is still being written, a second one can build up.
+    """
+
+    def __init__(self, size: int, jpeg_quality: int = None, max_bytes: int = None):
+        self.size = max(size, 0)
+        self.jpeg_quality = jpeg_quality
+        self.max_bytes = max_bytes
+
+        self._encoded = deque(maxlen=self.size)
+        self._frames = None
+        self._start = 0
+        self._count = 0
+
+    def __len__(self) -> int:
+        return len(self._encoded) if self.jpeg_quality else self._count
+
+    def append(self, frame: np_image) -> None:
+        if self.size == 0:
+            return
+
+        if not self.jpeg_quality and (self._frames is None or self._frames.shape[1:] != frame.shape):
+            if self.max_bytes and self.size * frame.nbytes > self.max_bytes:
+                logging.warning(
+                    f"A raw pre-roll of {self.size} frames would use {self.size * frame.nbytes / 1024 / 1024:.0f}MB "
+                    f"(more than {self.max_bytes / 1024 / 1024:.0f}MB). Compressing it at JPEG quality {FALLBACK_JPEG_QUALITY} instead."
+                )
+                self.jpeg_quality = FALLBACK_JPEG_QUALITY
+                self._frames = None
+            else:
+                self._frames = empty((self.size, *frame.shape), dtype=frame.dtype)
+                self._start = self._count = 0
+
+        if self.jpeg_quality:
+            _, encoded = cv2.imencode(".jpg", frame, [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality])
+            self._encoded.append(encoded.tobytes())
+            return
+
+        # Overwrite the oldest frame once the ring is full
+        slot = (self._start + self._count) % self.size
+        self._frames[slot] = frame
+        if self._count < self.size:
+            self._count += 1
+        else:
+            self._start = (self._start + 1) % self.size
+
+    def take(self):
+        """
+        Empty the buffer, and return an iterator over its frames (oldest
+        first). Nothing is decoded or copied until it's iterated, so that can
+        be left to another thread (e.g: `BackgroundVideoWriter.write_all()`).
+        """
+        if self.jpeg_quality:
+            encoded, self._encoded = self._encoded, deque(maxlen=self.size)
+            return (cv2.imdecode(frombuffer(data, dtype=uint8), cv2.IMREAD_COLOR) for data in encoded)
+
+        if not self._count:
+            return iter(())
+        frames, start, count = self._frames, self._start, self._count
+        # The next frame starts a new ring, rather than overwriting these
+        self._frames = None
+        self._start = self._count = 0
+        return (frames[(start + i) % self.size] for i in range(count))
+
+
+class BackgroundVideoWriter():
+    """
+    Encodes video on a dedicated thread, so that the stream is never held up
+    waiting for the encoder. Frames wait in a bounded queue, and are dropped
+    (and counted) if the encoder can't keep up.
+
+    The video is split into segments, named by the time they start. A new
+    segment is started every "rotate_seconds", once a segment reaches
+    "rotate_bytes", at midnight if "rotate_daily", or whenever `split()` is
+    called. The next segment is
+    opened before the last one is closed (on another thread), so no frames
+    are held up by the old file being finalised.
+
+    Frames must not be modified after they've been given to `write()`.
+
+    `mark()` finds out which file (and frame within it) a point in the
+    stream was written to, e.g: so that motion events can be found later.
+    """
+
+    def __init__(self,
+                 directory: str,
+                 prefix: str,
+                 codec: int,
+                 fps: float,
+                 size: tuple,
+                 queue_size: int = 50,
+                 rotate_seconds: int = None,
+                 rotate_bytes: int = None,
+                 rotate_daily: bool = False,
+                 extension: str = "avi",
+                ):
+        self.directory = directory
+        self.prefix = prefix
+        self.codec = codec
+        self.fps = fps
+        self.size = size
+        self.rotate_seconds = rotate_seconds
+        self.rotate_bytes = rotate_bytes
+        self.rotate_daily = rotate_daily
+        self.extension = extension
+
+        self._queue = queue.Queue(maxsize=max(queue_size, 1))
+        self._writer = None
+        self._filename = None
+        self._opened_at = 0
+        self._opened_on = None
+        self._closers = []
+        self._marks = []
+        self._segment_frames = 0
+
+        # Metrics
+        self.frames_written = 0
+        self.frames_dropped = 0
+        self.segments = 0
+        self.encode_seconds = 0
+        self.max_encode_seconds = 0
+
+        pathlib.Path(self.directory).mkdir(parents=True, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="video-writer", daemon=True)
+        self._thread.start()
+
+    @property
+    def depth(self) -> int:
+        return self._queue.qsize()
+
+    def write(self, frame, block: bool = False) -> bool:
+        """
+        Queue a frame to be encoded. Returns False if it had to be dropped.
+        """
+        try:
+            self._queue.put(frame, block=block)
+            return True
+        except queue.Full:
+            self.frames_dropped += 1
+            return False
+
+    def write_all(self, frames) -> None:
+        """
+        Queue several frames (e.g: a pre-roll) to be encoded, as one item.
+        They're only iterated on the encoder thread, so an iterator that
+        decodes them costs the caller nothing. They're never dropped, so this
+        may wait for space.
+        """
+        self._queue.put(_Frames(frames))
+
+    def mark(self, callback, before_next: bool = True) -> None:
+        """
+        Call "callback(filename, frame_offset)" from the encoder thread, once
+        everything queued so far has been written.
+
+        If "before_next" is True, it's the position of the next frame to be
+        written (which may be in a new segment). Otherwise it's the position
+        just after the last frame written. The filename is None if there's
+        no such frame. Marks are never dropped, so this may wait for space.
+        """
+        self._queue.put(_Mark(callback, before_next))
+
+    def split(self) -> None:
+        """
+        Finish the current segment. The next frame will start a new one.
+        """
+        self._queue.put(_SPLIT)
+
+    def release(self) -> None:
+        """
+        Encode everything that's queued, and close the file.
+        """
+        self._queue.put(_STOP)
+        self._thread.join()
+        for closer in self._closers:
+            closer.join()
+
+    def stats(self) -> dict:
+        return {
+            "frames_written": self.frames_written,
+            "frames_dropped": self.frames_dropped,
+            "queue_depth": self.depth,
+            "segments": self.segments,
+            "mean_encode_ms": round(1000 * self.encode_seconds / max(self.frames_written, 1), 2),
+            "max_encode_ms": round(1000 * self.max_encode_seconds, 2),
+        }
+
+    def _due_for_rotation(self) -> bool:
+        if self.rotate_seconds and time.monotonic() - self._opened_at >= self.rotate_seconds:
+            return True
+        if self.rotate_daily and datetime.now().date() != self._opened_on:
+            return True
+        # Checking the file size is a syscall, so only do it about once a second
+        if self.rotate_bytes and self.frames_written % max(int(self.fps), 1) == 0:
+            try:
+                return os.path.getsize(self._filename) >= self.rotate_bytes
+            except OSError:
+                return False
+        return False
+
+    def _open(self) -> None:
+        old_writer = self._writer
+
+        start_time = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
+        filename = f"{self.directory}/{self.prefix}{start_time}.{self.extension}"
+        if filename == self._filename:
+            # Don't clobber a segment that started in the same second
+            filename = f"{self.directory}/{self.prefix}{start_time}_{self.segments}.{self.extension}"
+        self._filename = filename
+
+        logging.debug(f"Starting video segment '{self._filename}'.")
+        self._writer = cv2.VideoWriter(self._filename, self.codec, self.fps, self.size)
+        self._opened_at = time.monotonic()
+        self._opened_on = datetime.now().date()
+        self._segment_frames = 0
+        self.segments += 1
+
+        if old_writer is not None:
+            self._close(old_writer)
+
+    def _close(self, writer) -> None:
+        # Finalising a file can be slow, so don't make the next frame wait
+        self._closers = [closer for closer in self._closers if closer.is_alive()]
+        closer = threading.Thread(target=writer.release, name="video-closer", daemon=True)
+        closer.start()
+        self._closers.append(closer)
+
+    def _run(self) -> None:
+        while True:
+            frame = self._queue.get()
+            if isinstance(frame, _Mark):
+                if frame.before_next:
+                    self._marks.append(frame.callback)
+                elif self._writer is not None:
+                    frame.callback(self._filename, self._segment_frames)
+                else:
+                    frame.callback(None, None)
+                continue
+
+            if frame is _STOP or frame is _SPLIT:
+                if self._writer is not None:
+                    self._close(self._writer)
+                    self._writer = None
+                if frame is _STOP:
+                    # Nothing else will be written
+                    for callback in self._marks:
+                        callback(None, None)
+                    return
+                continue
+
+            if isinstance(frame, _Frames):
+                for each_frame in frame.frames:
+                    self._write(each_frame)
+                continue
+            self._write(frame)
+
+    def _write(self, frame) -> None:
+        if self._writer is None or self._due_for_rotation():
+            self._open()
+
+        for callback in self._marks:
+            callback(self._filename, self._segment_frames)
+        self._marks.clear()
+
+        encode_start = time.perf_counter()
+        self._writer.write(frame)
+        encode_seconds = time.perf_counter() - encode_start
+
+        self.frames_written += 1
+        self._segment_frames += 1
+        self.encode_seconds += encode_seconds
+        self.max_encode_seconds = max(self.max_encode_seconds, encode_seconds)
@@ -0,0 +1,269 @@
+"""
+StreamWatch Batch
+
+Re-runs motion detection over recorded footage, using every core. Each file
+(or every file in a directory) is split into time ranges, and each range is
+analysed by its own worker process, which seeks straight to it.
+
+Each range starts a little early (the overlap), so the detector has some
+history and knows whether motion was already happening. A range only keeps
+the events that start inside it, but follows them past its end until they
+stop, so events that cross a boundary are found once. Events that still
+touch after that are merged.
+
+The events are written to the same SQLite database as live runs (see
+event_index.py), so they can be listed and extracted with streamwatch.events.
+
+Run it as a module:
+    python3 -m streamwatch.batch /media/driveway --event-db events.db
+"""
+
+import os
+import re
+import cv2
+import json
+import time
+import logging
+import argparse
+from collections import namedtuple
+from datetime import datetime
+from multiprocessing import Pool
+
+from local_utilities.logging_utils import begin_logging_to_stdout
+from local_utilities import image_utils
+from local_utilities.region_mask import RegionMask
+from local_utilities.event_index import EventIndex, MotionEvent
+from local_utilities.motion_analysis import FrameAnalyser, MotionTracker, MOTION_STARTED, MOTION_CONTINUING, MOTION_STOPPED
+
+VIDEO_EXTENSIONS = (".avi", ".mp4", ".mkv", ".mov")
+# StreamWatch names its videos "<prefix><YYYY-MM-DD_HH-MM-SS>.avi"
+TIMESTAMP = re.compile(r"(\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2})")
+
+# All positions are in frames. Frames from "warmup" to "start" are only used
+# to prime the detector. Events that start from "start" to "end" are kept.
+TimeRange = namedtuple("TimeRange", ["path", "fps", "warmup", "start", "end", "frames"])
+# A motion event found in a file, as (x, y, w, h) and frame numbers
+FoundEvent = namedtuple("FoundEvent", ["path", "start_frame", "end_frame", "box", "peak_area"])
+
+
+def find_videos(paths: list) -> list:
+    videos = []
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.lower().endswith(VIDEO_EXTENSIONS):
+                    videos.append(os.path.join(path, name))
+        else:
+            videos.append(path)
+    return videos
+
+
+def split_video(path: str, range_seconds: int, overlap_seconds: int) -> list:
+    """
+    Split a video into time ranges, which overlap by "overlap_seconds".
+    """
+    cap = cv2.VideoCapture(path)
+    fps = cap.get(cv2.CAP_PROP_FPS) or 25
+    frames = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    cap.release()
+    if frames <= 0:
+        logging.warning(f"Can't tell how long '{path}' is. Skipping it.")
+        return []
+
+    length = max(int(range_seconds * fps), 1)
+    overlap = int(overlap_seconds * fps)
+    return [
+        TimeRange(path, fps, max(start - overlap, 0), start, min(start + length, frames), frames)
+        for start in range(0, frames, length)
+    ]
+
+
+def analyse_range(time_range: TimeRange, options: dict) -> tuple:
+    """
+    Find the motion events that start within a time range. Runs in a worker.
+
+    Frames are analysed and motion is tracked by the same code StreamWatch
+    uses live (see motion_analysis.py), so the events match.
+    """
+    path, fps, warmup, start, end, frames = time_range
+    cap = cv2.VideoCapture(path)
+    if warmup > 0:
+        cap.set(cv2.CAP_PROP_POS_FRAMES, warmup)
+
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+    stride = max(-(-int(fps) // options["analysis_fps"]), 1) if options.get("analysis_fps") else 1
+    region_mask = RegionMask(options["mask"], width, height) if options.get("mask") else None
+
+    detector = image_utils.create_motion_detector(options.get("detector") or "framediff", int(fps) // stride)
+    analyser = FrameAnalyser(
+        detector,
+        width,
+        height,
+        int(fps),
+        region_mask,
+        options.get("analysis_width"),
+        options.get("pyramid_level"),
+    )
+    tracker = MotionTracker(int(fps))
+
+    events = []
+    event = None
+    frames_read = 0
+    for frame_num in range(warmup, frames):
+        if frame_num >= end and event is None:
+            # Anything from here on belongs to the next range
+            break
+
+        ok, frame = cap.read()
+        if not ok:
+            break
+        frames_read += 1
+        if frame_num % stride:
+            continue
+
+        motion_area = analyser.analyse(frame)
+        change = tracker.update(motion_area, stride)
+        if change == MOTION_STOPPED and event is not None:
+            events.append(event._replace(end_frame=frame_num))
+            event = None
+        elif change == MOTION_STARTED:
+            # Events that started before this range belong to the last one
+            if start <= frame_num < end:
+                event = FoundEvent(path, frame_num, None, motion_area, motion_area[2] * motion_area[3])
+        elif change == MOTION_CONTINUING and event is not None and motion_area[2] * motion_area[3] > event.peak_area:
+            event = event._replace(box=motion_area, peak_area=motion_area[2] * motion_area[3])
+
+    if event is not None:
+        # The file ended during the event
+        events.append(event._replace(end_frame=warmup + frames_read))
+    cap.release()
+    return time_range, events, frames_read
+
+
+def _analyse_range(args: tuple) -> tuple:
+    # Pool.imap only passes one argument
+    cv2.setNumThreads(1)
+    return analyse_range(*args)
+
+
+def merge_events(events: list) -> list:
+    """
+    Merge events from the same file that overlap or touch.
+    """
+    merged = []
+    for event in sorted(events, key=lambda e: (e.path, e.start_frame)):
+        last = merged[-1] if merged else None
+        if last is not None and last.path == event.path and event.start_frame <= last.end_frame:
+            peak = event if event.peak_area > last.peak_area else last
+            merged[-1] = last._replace(
+                end_frame=max(last.end_frame, event.end_frame),
+                box=peak.box,
+                peak_area=peak.peak_area,
+            )
+        else:
+            merged.append(event)
+    return merged
+
+
+def video_start_time(path: str, fps: float, frames: int) -> float:
+    """
+    When a video started, from its name if StreamWatch recorded it, or else
+    from when it was last modified.
+    """
+    match = TIMESTAMP.search(os.path.basename(path))
+    if match:
+        return datetime.strptime(match.group(1), "%Y-%m-%d_%H-%M-%S").timestamp()
+    return os.path.getmtime(path) - frames / fps
+
+
+def camera_name(path: str) -> str:
+    prefix = TIMESTAMP.split(os.path.basename(path))[0]
+    return prefix.strip("_") or "camera"
+
+
+def run(videos: list, event_db: str, options: dict, camera: str = None, workers: int = None,
+        range_seconds: int = 300, overlap_seconds: int = 10) -> list:
+    ranges = []
+    for path in videos:
+        ranges += split_video(path, range_seconds, overlap_seconds)
+    workers = workers or os.cpu_count()
+    logging.info(f"Analysing {len(videos)} videos as {len(ranges)} time ranges, with {workers} workers.")
+
+    found = []
+    frames_read = 0
+    start = time.monotonic()
+    with Pool(workers) as pool:
+        for time_range, events, frames in pool.imap_unordered(_analyse_range, [(r, options) for r in ranges]):
+            found += events
+            frames_read += frames
+            logging.debug(f"Analysed frames {time_range.start}-{time_range.end} of '{time_range.path}': {len(events)} events.")
+    seconds = time.monotonic() - start
+
+    events = merge_events(found)
+    logging.info(f"Found {len(events)} motion events in {seconds:.0f}s ({frames_read / max(seconds, 0.001):.0f} FPS).")
+
+    index = EventIndex(event_db)
+    lengths = {r.path: (r.fps, r.frames) for r in ranges}
+    for event in events:
+        fps, frames = lengths[event.path]
+        video_start = video_start_time(event.path, fps, frames)
+        motion_event = MotionEvent(camera or camera_name(event.path), event.box, fps)
+        motion_event.start_time = video_start + event.start_frame / fps
+        motion_event.end_time = video_start + event.end_frame / fps
+        motion_event.peak_area = event.peak_area
+        motion_event.set_start(event.path, event.start_frame)
+        motion_event.set_end(event.path, event.end_frame)
+        index.record(motion_event)
+    index.close()
+    logging.info(f"Wrote {index.events_written} motion events to '{event_db}'.")
+    return events
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="batch",
+        description="Detects motion in recorded videos, in parallel",
+    )
+
+    parser.add_argument("paths", type=str, nargs="+",
+        help="The videos to analyse, or directories of them.")
+    parser.add_argument("--event-db", type=str, required=True,
+        help="The SQLite database to write motion events to.")
+    parser.add_argument("--camera", type=str,
+        help="The camera to file the events under. Defaults to the prefix of each file's name.")
+    parser.add_argument("--workers", "-w", type=int,
+        help="The number of worker processes. Defaults to the number of CPUs.")
+    parser.add_argument("--range-seconds", type=int, default=300,
+        help="The length of video each worker analyses at once. Defaults to 300.")
+    parser.add_argument("--overlap-seconds", type=int, default=10,
+        help="How far before its range each worker starts, to prime the detector. Defaults to 10.")
+    parser.add_argument("--detector", "-m", type=str, choices=image_utils.MOTION_DETECTORS,
+        help="The motion detection engine. Defaults to framediff.")
+    parser.add_argument("--analysis-width", "-a", type=int,
+        help="Shrink frames to this width before detecting motion.")
+    parser.add_argument("--pyramid-level", type=int,
+        help="Halve frames this many times before detecting motion. Overrides --analysis-width.")
+    parser.add_argument("--analysis-fps", type=int,
+        help="The max FPS to analyse.")
+    parser.add_argument("--mask", type=str,
+        help="A JSON file of polygons to include/exclude from motion detection. See region_mask.py.")
+
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO)
+    begin_logging_to_stdout()
+
+    mask = None
+    if args.mask:
+        with open(args.mask, "r") as f:
+            mask = json.loads(f.read())
+
+    options = {
+        "detector": args.detector,
+        "analysis_width": args.analysis_width,
+        "pyramid_level": args.pyramid_level,
+        "analysis_fps": args.analysis_fps,
+        "mask": mask,
+    }
+    run(find_videos(args.paths), args.event_db, options, args.camera, args.workers, args.range_seconds, args.overlap_seconds)
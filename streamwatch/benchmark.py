@@ -0,0 +1,325 @@
+"""
+StreamWatch Benchmark
+
+Measures how fast the StreamWatch pipeline runs on this host, without a live
+camera. Synthetic test videos are generated for each scene and resolution,
+then replayed from file:// URLs through StreamWatch itself (recording video
+and images), as fast as possible. The time spent in each stage comes from
+StreamWatch's own metrics. Video and images are encoded on their own threads
+(so the "video" and "image" stages are only queueing them), so the writers'
+own stats are reported too.
+
+Scenes:
+ - static: A still scene. Nothing should be detected.
+ - blobs: Coloured blobs moving across a still scene.
+ - ir: A greyscale (nightvision) scene, with a moving blob.
+ - noise: Random noise in every frame. The worst case for detection.
+
+With --allocations, it also measures how much memory the analysis (see
+`FrameAnalyser`) allocates per frame once they've warmed up (with tracemalloc), with and
+without a `DetectionWorkspace`.
+
+With --bands, each video is replayed again with motion detection split into
+bands on a thread pool (see `BandPool`). The speedup of the detect stage is
+reported, and the motion found is checked against the first run,
+frame by frame, as it should be exactly the same.
+
+The results are written as JSON, so that runs can be compared between
+changes and between hosts.
+
+Run it as a module:
+    python3 -m streamwatch.benchmark --output results.json
+"""
+
+import os
+import cv2
+import json
+import time
+import logging
+import platform
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+from datetime import datetime
+
+from local_utilities.logging_utils import begin_logging_to_stdout
+from local_utilities import image_utils
+from local_utilities.motion_analysis import FrameAnalyser
+from streamwatch.streamwatch import StreamWatch
+
+SCENES = ("static", "blobs", "ir", "noise")
+FPS = 25
+
+
+def make_background(width: int, height: int, greyscale: bool = False) -> np.ndarray:
+    """
+    A still scene with some structure (gradients and shapes), like a real camera.
+    """
+    rng = np.random.default_rng(0)
+    x, y = np.meshgrid(np.linspace(0, 255, width, dtype=np.float32), np.linspace(0, 255, height, dtype=np.float32))
+    background = np.dstack([
+        (x * 0.5 + y * 0.3),
+        (x * 0.2 + y * 0.6),
+        (255 - x * 0.4),
+    ]).astype(np.uint8)
+    for _ in range(12):
+        x1, y1 = int(rng.integers(0, width)), int(rng.integers(0, height))
+        x2, y2 = x1 + width // 8, y1 + height // 8
+        colour = tuple(int(c) for c in rng.integers(0, 255, 3))
+        cv2.rectangle(background, (x1, y1), (x2, y2), colour, -1)
+
+    if greyscale:
+        grey = cv2.cvtColor(background, cv2.COLOR_BGR2GRAY)
+        background = cv2.cvtColor(grey, cv2.COLOR_GRAY2BGR)
+    return background
+
+
+def make_video(path: str, scene: str, width: int, height: int, frames: int) -> None:
+    """
+    Write a synthetic test video.
+    """
+    rng = np.random.default_rng(1)
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*"MJPG"), FPS, (width, height))
+    background = make_background(width, height, greyscale=(scene == "ir"))
+    radius = max(min(width, height) // 12, 2)
+
+    for i in range(frames):
+        if scene == "noise":
+            frame = rng.integers(0, 255, (height, width, 3), dtype=np.uint8)
+        else:
+            frame = background.copy()
+
+        if scene in ("blobs", "ir"):
+            # Blobs move across the frame, and bounce back
+            for j, colour in enumerate(((0, 0, 255), (0, 255, 0), (255, 0, 0))):
+                travel = (i * (4 + j) * width // 200) % (2 * width)
+                x = travel if travel < width else 2 * width - travel
+                y = (j + 1) * height // 4
+                if scene == "ir":
+                    colour = (200, 200, 200)
+                cv2.circle(frame, (x, y), radius, colour, -1)
+
+        writer.write(frame)
+    writer.release()
+
+
+def summarise(histogram) -> dict:
+    """
+    Summarise a stage's histogram as milliseconds. The mean is exact, but the
+    percentiles are the upper bounds of the buckets they fall into.
+    """
+    if not histogram.count:
+        return {}
+    return {
+        "count": histogram.count,
+        "mean": round(histogram.sum / histogram.count * 1000, 3),
+        "p50": round(histogram.quantile(0.50) * 1000, 3),
+        "p90": round(histogram.quantile(0.90) * 1000, 3),
+        "p99": round(histogram.quantile(0.99) * 1000, 3),
+    }
+
+
+class BenchmarkWatch(StreamWatch):
+    """
+    A StreamWatch that remembers the motion found in every analysed frame,
+    so that runs can be compared.
+    """
+
+    def setup(self):
+        super().setup()
+        self.motion_areas = []
+
+    def handle_motion(self, motion_area, frames: int = 1):
+        self.motion_areas.append(motion_area)
+        super().handle_motion(motion_area, frames)
+
+
+def replay(url: str, work_dir: str, detector_name: str, analysis_width: int = None, bands: int = None) -> dict:
+    """
+    Replay a video through StreamWatch, recording video and images, and
+    report the time it spent in each stage (from its own metrics).
+    """
+    with tempfile.TemporaryDirectory(dir=work_dir) as output_dir:
+        wall_start = time.perf_counter()
+        watcher = BenchmarkWatch(
+            url=url,
+            prefix="replay_",
+            video_path=f"{output_dir}/video",
+            image_path=f"{output_dir}/images",
+            detector=detector_name,
+            analysis_width=analysis_width,
+            detect_bands=bands,
+            metrics_interval=3600,
+            headless=True,
+        )
+        wall_seconds = time.perf_counter() - wall_start
+
+    frames = watcher.reader.frames_read - watcher.reader.read_failures
+    return {
+        "width": watcher.stream_width,
+        "height": watcher.stream_height,
+        "frames": frames,
+        "motion_frames": sum(1 for area in watcher.motion_areas if area != (0, 0, 0, 0)),
+        "motion_events": watcher.motion_events,
+        "fps": round(frames / wall_seconds, 2) if wall_seconds else None,
+        "stages": {stage: summarise(histogram) for stage, histogram in watcher.metrics.stages.items()},
+        # The encoding itself, which the "video" and "image" stages don't include
+        "video_writer": watcher.video_writer.stats(),
+        "snapshot_writer": watcher.snapshot_writer.stats(),
+        "motion_areas": watcher.motion_areas,
+    }
+
+
+def allocations(url: str, detector_name: str, analysis_width: int = None, use_workspace: bool = True, warmup: int = 25) -> dict:
+    """
+    Measure how many bytes the analysis stages allocate for each frame, once
+    the detector has warmed up. Decoding isn't counted.
+
+    tracemalloc sees numpy's allocations, which includes OpenCV's outputs.
+    The peak during a frame (above what was allocated before it) is the
+    memory that frame churned through.
+    """
+    cap = cv2.VideoCapture(url)
+    fps = int(cap.get(cv2.CAP_PROP_FPS)) or FPS
+    width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+    height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+
+    detector = image_utils.create_motion_detector(detector_name, fps)
+    analyser = FrameAnalyser(detector, width, height, fps, analysis_width=analysis_width)
+    if not use_workspace:
+        # Every function allocates its own outputs, as if there were no workspace
+        analyser.workspace = None
+    workspace = analyser.workspace
+
+    samples = []
+    tracemalloc.start()
+    while True:
+        ok, frame = cap.read()
+        if not ok:
+            break
+
+        tracemalloc.reset_peak()
+        before, _ = tracemalloc.get_traced_memory()
+        analyser.analyse(frame)
+        _, peak = tracemalloc.get_traced_memory()
+        samples.append(peak - before)
+    tracemalloc.stop()
+    cap.release()
+
+    steady = samples[warmup:] or samples
+    return {
+        "workspace": use_workspace,
+        "frames": len(steady),
+        "mean_bytes_per_frame": round(sum(steady) / max(len(steady), 1)),
+        "max_bytes_per_frame": max(steady, default=0),
+        "workspace_buffers": workspace.allocations if workspace else None,
+        "workspace_bytes": workspace.nbytes if workspace else None,
+    }
+
+
+def host_info() -> dict:
+    return {
+        "hostname": platform.node(),
+        "machine": platform.machine(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "opencv": cv2.__version__,
+        "cpus": os.cpu_count(),
+    }
+
+
+def run(resolutions: list, scenes: list, frames: int, detector_name: str, analysis_width: int, work_dir: str,
+        measure_allocations: bool = False, bands: int = None) -> dict:
+    results = []
+    for width, height in resolutions:
+        for scene in scenes:
+            path = f"{work_dir}/{scene}_{width}x{height}.avi"
+            if not os.path.isfile(path):
+                logging.info(f"Generating {frames} frames of '{scene}' at {width}x{height}.")
+                make_video(path, scene, width, height, frames)
+
+            logging.info(f"Replaying '{scene}' at {width}x{height}.")
+            url = f"file://{os.path.abspath(path)}"
+            result = replay(url, work_dir, detector_name, analysis_width)
+            result["scene"] = scene
+            motion_areas = result.pop("motion_areas")
+            logging.info(f"'{scene}' at {width}x{height}: {result['fps']} FPS.")
+
+            if bands and bands > 1:
+                banded = replay(url, work_dir, detector_name, analysis_width, bands)
+                single, split = result["stages"]["detect"], banded["stages"]["detect"]
+                result["bands"] = {
+                    "bands": bands,
+                    "fps": banded["fps"],
+                    "detect": split,
+                    "speedup": round(single["mean"] / split["mean"], 2) if split.get("mean") else None,
+                    "matches_single_thread": banded["motion_areas"] == motion_areas,
+                }
+                logging.info(f"'{scene}' at {width}x{height}: detection is {result['bands']['speedup']}x as fast in {bands} bands.")
+                if not result["bands"]["matches_single_thread"]:
+                    logging.warning(f"'{scene}' at {width}x{height}: the motion found in bands doesn't match the single thread!")
+
+            if measure_allocations:
+                result["allocations"] = [
+                    allocations(url, detector_name, analysis_width, use_workspace)
+                    for use_workspace in (False, True)
+                ]
+                before, after = (a["mean_bytes_per_frame"] for a in result["allocations"])
+                logging.info(f"'{scene}' at {width}x{height}: {before / 1024:.0f}KB allocated per frame without a workspace, {after / 1024:.0f}KB with one.")
+            results.append(result)
+
+    return {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "host": host_info(),
+        "detector": detector_name,
+        "analysis_width": analysis_width,
+        "bands": bands,
+        "results": results,
+    }
+
+
+def parse_resolution(text: str) -> tuple:
+    width, height = text.lower().split("x")
+    return int(width), int(height)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="benchmark",
+        description="Benchmarks the StreamWatch pipeline with synthetic videos",
+    )
+
+    parser.add_argument("--output", "-o", type=str, required=True,
+        help="The JSON file to write the results to.")
+    parser.add_argument("--resolutions", "-r", type=parse_resolution, nargs="+",
+        default=[(640, 360), (1280, 720), (1920, 1080)],
+        help="The resolutions to test, e.g: 1920x1080. Defaults to 360p, 720p and 1080p.")
+    parser.add_argument("--scenes", type=str, nargs="+", choices=SCENES, default=list(SCENES),
+        help="The scenes to test. Defaults to all of them.")
+    parser.add_argument("--frames", "-f", type=int, default=250,
+        help="The number of frames in each test video. Defaults to 250.")
+    parser.add_argument("--detector", "-m", type=str, choices=image_utils.MOTION_DETECTORS, default="framediff",
+        help="The motion detection engine. Defaults to framediff.")
+    parser.add_argument("--analysis-width", "-a", type=int,
+        help="Shrink frames to this width before detecting motion.")
+    parser.add_argument("--video-dir", type=str,
+        help="Keep the generated videos here, to reuse them next time.")
+    parser.add_argument("--allocations", action='store_true',
+        help="Also measure the memory allocated per frame, with and without a DetectionWorkspace.")
+    parser.add_argument("--bands", type=int,
+        help="Also replay with motion detection split into this many bands on threads, and report the speedup.")
+
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO)
+    begin_logging_to_stdout()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        work_dir = args.video_dir or temp_dir
+        os.makedirs(work_dir, exist_ok=True)
+        results = run(args.resolutions, args.scenes, args.frames, args.detector, args.analysis_width, work_dir, args.allocations, args.bands)
+
+    with open(args.output, "w") as f:
+        f.write(json.dumps(results, indent=4))
+    logging.info(f"Wrote results to '{args.output}'.")
@@ -0,0 +1,123 @@
+"""
+StreamWatch Events
+
+Lists the motion events recorded by StreamWatch (with --event-db), and cuts
+their footage out of the recordings.
+
+Extracting only reads the frames it needs. ffmpeg seeks straight to the
+event (using the file's index), and copies the frames without re-encoding
+them. As video can only be cut at keyframes, clips may start slightly early.
+
+Run it as a module:
+    python3 -m streamwatch.events --db events.db list --since "2024-01-01 08:00"
+    python3 -m streamwatch.events --db events.db extract --since "2024-01-01 08:00" --output clips
+"""
+
+import os
+import logging
+import argparse
+import subprocess
+from datetime import datetime
+
+from local_utilities.logging_utils import begin_logging_to_stdout
+from local_utilities.event_index import connect, find_events
+
+DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def parse_time(text: str) -> float:
+    return datetime.fromisoformat(text).timestamp()
+
+
+def format_time(seconds: float) -> str:
+    return datetime.fromtimestamp(seconds).strftime(DATE_FORMAT)
+
+
+def list_events(events: list) -> None:
+    for event in events:
+        box = (event["box_x"], event["box_y"], event["box_w"], event["box_h"])
+        location = "not recorded"
+        if event["video_file"]:
+            location = f"{event['video_file']} from frame {event['start_frame']}"
+        print(f"#{event['id']} [{event['camera']}] {format_time(event['start_time'])} "
+              f"for {event['end_time'] - event['start_time']:.0f}s, peak {box}: {location}")
+
+
+def extract_event(event, output_dir: str, padding: float = 2, ffmpeg: str = "ffmpeg") -> str:
+    """
+    Copy an event's frames out of its recording, into a new file.
+    Returns the new file's path, or None if it couldn't be extracted.
+    """
+    if not event["video_file"] or not event["video_fps"]:
+        logging.warning(f"Event #{event['id']} wasn't recorded.")
+        return None
+    if not os.path.isfile(event["video_file"]):
+        logging.warning(f"The recording of event #{event['id']} ('{event['video_file']}') is missing.")
+        return None
+
+    fps = event["video_fps"]
+    start = max(event["start_frame"] / fps - padding, 0)
+    command = [ffmpeg, "-hide_banner", "-loglevel", "error", "-nostdin", "-y", "-ss", f"{start:.3f}", "-i", event["video_file"]]
+    if event["end_frame"] is not None:
+        duration = (event["end_frame"] - event["start_frame"]) / fps + 2 * padding
+        command += ["-t", f"{duration:.3f}"]
+    else:
+        logging.info(f"Event #{event['id']} continues into the next file. Extracting to the end of this one.")
+    extension = os.path.splitext(event["video_file"])[1]
+    output = f"{output_dir}/{event['camera']}_{event['id']}{extension}"
+    command += ["-c", "copy", output]
+
+    result = subprocess.run(command, capture_output=True)
+    if result.returncode != 0:
+        logging.warning(f"Failed to extract event #{event['id']}: {result.stderr.decode().strip()}")
+        return None
+    return output
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog="events",
+        description="Lists and extracts StreamWatch motion events",
+    )
+
+    parser.add_argument("--db", type=str, required=True,
+        help="The event database written by StreamWatch (--event-db).")
+    parser.add_argument("action", type=str, choices=("list", "extract"),
+        help="List the events, or extract their footage.")
+    parser.add_argument("--since", type=str,
+        help="Only events after this time, e.g: '2024-01-01 08:00'.")
+    parser.add_argument("--until", type=str,
+        help="Only events before this time.")
+    parser.add_argument("--camera", type=str,
+        help="Only events from this camera.")
+    parser.add_argument("--id", type=int, nargs="+",
+        help="Only these events.")
+    parser.add_argument("--output", "-o", type=str, default=".",
+        help="The directory to extract clips to. Defaults to the current directory.")
+    parser.add_argument("--padding", type=float, default=2,
+        help="Seconds of video to keep either side of each event. Defaults to 2.")
+
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.INFO)
+    begin_logging_to_stdout()
+
+    connection = connect(args.db)
+    events = find_events(
+        connection,
+        since=parse_time(args.since) if args.since else None,
+        until=parse_time(args.until) if args.until else None,
+        camera=args.camera,
+    )
+    if args.id:
+        events = [event for event in events if event["id"] in args.id]
+
+    if args.action == "list":
+        list_events(events)
+    else:
+        os.makedirs(args.output, exist_ok=True)
+        for event in events:
+            path = extract_event(event, args.output, args.padding)
+            if path:
+                logging.info(f"Extracted event #{event['id']} to '{path}'.")
+    connection.close()
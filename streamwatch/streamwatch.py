@@ -1,22 +1,50 @@
 #!/usr/bin/env python3
 
 import cv2
+import json
 import time
+import signal
 import logging
-import pathlib
 import argparse
-from decimal import Decimal
+import threading
 from datetime import datetime, timedelta
-from multiprocessing import Pipe, Process
+from multiprocessing import Process
 
 from local_utilities.logging_utils import simple_logging
+from local_utilities.backoff import Backoff
 from local_utilities import image_utils, image_saver
+from local_utilities.frame_reader import FrameReader, DROP_POLICIES, DROP_OLDEST, BLOCK
+from local_utilities.shared_frames import SharedFrameRing
+from local_utilities.video_utils import PreRollBuffer, BackgroundVideoWriter
+from local_utilities.snapshot_writer import SnapshotWriter, FORMATS as IMAGE_FORMATS
+from local_utilities.load_control import LoadController, DEFAULT_TEMPERATURE_PATH
+from local_utilities.metrics import Metrics, MetricsServer
+from local_utilities.ffmpeg_capture import FFmpegCapture, probe
+from local_utilities.motion_vectors import MotionVectorCapture, MotionVectorDetector
+from local_utilities.region_mask import RegionMask
+from local_utilities.motion_analysis import FrameAnalyser, MotionTracker, MOTION_STARTED, MOTION_CONTINUING, MOTION_STOPPED
+from local_utilities.event_index import EventIndex, MotionEvent
+from local_utilities.preview_server import PreviewServer
+from local_utilities.stream_recorder import StreamCopyRecorder, RECORD_BACKENDS, FORMATS as VIDEO_FORMATS
 
 
-simple_logging("streamwatch", level=logging.DEBUG, stdout=True)
-
 MAX_STABILITY = 5
-MAX_MOTION_SECONDS = 5
+
+RECORD_CONTINUOUS = "continuous"
+RECORD_MOTION = "motion"
+# Keeps a frame every "idle_interval" seconds, and the full FPS during motion
+RECORD_TIMELAPSE = "timelapse"
+RECORD_MODES = (RECORD_CONTINUOUS, RECORD_MOTION, RECORD_TIMELAPSE)
+
+CAPTURE_BACKENDS = ("opencv", "ffmpeg")
+
+# Uses the stream's own motion vectors, instead of comparing pixels
+VECTOR_DETECTOR = "vectors"
+DETECTORS = image_utils.MOTION_DETECTORS + (VECTOR_DETECTOR,)
+
+
+def capture_size(cap) -> tuple:
+    return (int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)))
 
 
 class StreamWatch():
@@ -29,6 +57,48 @@ class StreamWatch():
                  video_path: str = None,
                  image_path: str = None,
                  debug: bool = False,
+                 buffer_size: int = 4,
+                 drop_policy: str = None,
+                 analysis_width: int = None,
+                 pyramid_level: int = None,
+                 detector: str = "framediff",
+                 record_mode: str = RECORD_CONTINUOUS,
+                 pre_roll: int = 5,
+                 post_roll: int = 5,
+                 pre_roll_quality: int = None,
+                 pre_roll_mb: int = 128,
+                 analysis_fps: int = None,
+                 stats_callback=None,
+                 stats_interval: int = 60,
+                 adaptive: bool = False,
+                 temperature_path: str = None,
+                 max_temperature: float = 75,
+                 segment_minutes: int = None,
+                 segment_mb: int = None,
+                 image_quality: int = 90,
+                 image_format: str = "jpg",
+                 metrics_port: int = None,
+                 metrics_interval: int = 60,
+                 capture_backend: str = "opencv",
+                 decode_width: int = None,
+                 decode_fps: int = None,
+                 keyframes_only: bool = False,
+                 mask: dict = None,
+                 event_db: str = None,
+                 idle_interval: int = 60,
+                 preview_port: int = None,
+                 preview_host: str = None,
+                 preview_width: int = 640,
+                 preview_fps: int = 5,
+                 record_url: str = None,
+                 record_offset: float = 0,
+                 record_backend: str = "opencv",
+                 video_format: str = "mkv",
+                 detect_bands: int = None,
+                 image_dedupe: int = None,
+                 image_keepalive: int = 5,
+                 stop_event: threading.Event = None,
+                 headless: bool = False,
                 ):
         # Deal with params
         self.url = url
@@ -39,6 +109,49 @@ class StreamWatch():
         self.video_path = video_path
         self.image_path = image_path
         self.debug = debug or False
+        self.buffer_size = buffer_size or 4
+        self.drop_policy = drop_policy
+        self.analysis_width = analysis_width
+        self.pyramid_level = pyramid_level
+        self.detector_name = detector or "framediff"
+        self.record_mode = record_mode or RECORD_CONTINUOUS
+        self.pre_roll = pre_roll if pre_roll is not None else 5
+        self.post_roll = post_roll if post_roll is not None else 5
+        self.pre_roll_quality = pre_roll_quality
+        self.pre_roll_mb = pre_roll_mb or 128
+        self.analysis_fps = analysis_fps
+        self.stats_callback = stats_callback
+        self.stats_interval = stats_interval or 60
+        self.adaptive = adaptive or False
+        self.temperature_path = temperature_path
+        self.max_temperature = max_temperature or 75
+        self.segment_minutes = segment_minutes
+        self.segment_mb = segment_mb
+        self.image_quality = image_quality or 90
+        self.image_format = image_format or "jpg"
+        self.metrics_port = metrics_port
+        self.metrics_interval = metrics_interval or 60
+        self.capture_backend = capture_backend or "opencv"
+        self.decode_width = decode_width
+        self.decode_fps = decode_fps
+        self.keyframes_only = keyframes_only or False
+        self.mask_config = mask
+        self.event_db = event_db
+        self.idle_interval = idle_interval or 60
+        self.preview_port = preview_port
+        self.preview_host = preview_host or "127.0.0.1"
+        self.preview_width = preview_width or 640
+        self.preview_fps = preview_fps or 5
+        self.record_url = record_url
+        self.record_offset = record_offset or 0
+        self.record_backend = record_backend or "opencv"
+        self.video_format = video_format or "mkv"
+        self.detect_bands = detect_bands
+        self.image_dedupe = image_dedupe
+        self.image_keepalive = image_keepalive or 5
+        # Set (e.g: by a signal handler) to finish cleanly
+        self.stop_event = stop_event or threading.Event()
+        self.headless = headless or False
 
         # Configure
         self.setup()
@@ -49,9 +162,40 @@ class StreamWatch():
     def setup(self):
         # Initialise internal variables
         self.video_writer = None
-        self.recent_motion = 0
+        self.snapshot_writer = None
+        self.recording = False
+        self.post_roll_remaining = 0
         self.stability = MAX_STABILITY
-        self.nightvision = False
+        self.reported_drops = 0
+        self.last_drop_report = 0
+        self.motion_area = (0, 0, 0, 0)
+        self.last_analysed = 0
+        self.last_stats = time.monotonic()
+        self.last_metrics = time.monotonic()
+        self.motion_events = 0
+        self.stability_drops = 0
+        self.connected = True
+        self.reconnects = 0
+        self.disconnected_seconds = 0
+        # Files end, but streams are reconnected
+        self.live = "://" in self.url and not self.url.startswith("file://")
+        if self.drop_policy is None:
+            # Every frame of a file can be read, so don't skip any
+            self.drop_policy = DROP_OLDEST if self.live else BLOCK
+        self.camera = self.prefix.strip("_") or "camera"
+        self.event = None
+        self.event_index = None
+        self.last_idle_frame = None
+        self.reader = None
+        self.main_reader = None
+        self.stream_recorder = None
+        self.saving_ring = None
+        self.saver_process = None
+        self.metrics_server = None
+        self.preview = None
+        self.shown_windows = False
+        self.metrics = Metrics("streamwatch", {"camera": self.camera})
+        self.band_pool = image_utils.BandPool(self.detect_bands) if self.detect_bands and self.detect_bands > 1 else None
 
         # Advanced customisation
         self.codec = cv2.VideoWriter_fourcc(*'XVID')
@@ -68,178 +212,741 @@ class StreamWatch():
             self.finish_time = self.start_time + timedelta(seconds=self.duration)
 
         self.formatted_start_time = self.start_time.strftime("%Y-%m-%d_%H-%M-%S")
-        if self.video_path:
-            self.output_video_file = f"{self.video_path}/{self.prefix}{self.formatted_start_time}.avi"
 
         if self.image_path:
-            self.image_path += f"/{self.prefix}{self.formatted_start_time}/"
-            pathlib.Path(self.image_path).mkdir(parents=True, exist_ok=True)
+            # Images are grouped into a subdirectory per hour, within this one
+            self.image_path += f"/{self.prefix}{self.formatted_start_time}"
+            self.snapshot_writer = SnapshotWriter(
+                self.image_path,
+                self.image_quality,
+                self.image_format,
+                dedupe_threshold=self.image_dedupe,
+                keepalive_seconds=self.image_keepalive * 60,
+            )
+
+        if self.event_db:
+            self.event_index = EventIndex(self.event_db)
+
+    def open_capture(self):
+        if self.detector_name == VECTOR_DETECTOR:
+            return MotionVectorCapture(self.url, decode_pixels=self.decode_pixels)
+        if self.capture_backend == "ffmpeg":
+            # ffmpeg scales/decimates while decoding, so the stream is smaller
+            return FFmpegCapture(
+                self.url,
+                width=self.decode_width,
+                fps=self.decode_fps,
+                keyframes_only=self.keyframes_only,
+                # The reader's ring, and the frames being read and analysed.
+                # The pool grows if the writers hold on to more.
+                buffers=self.buffer_size + 2,
+            )
+        return cv2.VideoCapture(self.url)
+
+    @property
+    def recent_motion(self) -> int:
+        return self.tracker.recent_motion
+
+    @property
+    def nightvision(self) -> bool:
+        return self.analyser.nightvision
+
+    @property
+    def frames_analysed(self) -> int:
+        return self.analyser.frames_analysed
+
+    @property
+    def decode_pixels(self) -> bool:
+        """
+        Whether the analysed stream's pixels are used at all. Motion vectors
+        don't need them, so they're only decoded if something else does.
+        """
+        if self.detector_name != VECTOR_DETECTOR or self.debug or self.preview_port:
+            return True
+        # In dual-stream mode, the main stream is what's recorded
+        return not self.record_url and bool(self.encoding or self.image_path)
+
+    @property
+    def encoding(self) -> bool:
+        """
+        Whether video is made from decoded frames (rather than copied).
+        """
+        return bool(self.video_path) and self.record_backend == "opencv"
 
     def watch(self) -> None:
-        cap = cv2.VideoCapture(self.url)
+        if self.video_path and self.record_backend == "copy" and self.record_mode == RECORD_TIMELAPSE:
+            raise SystemExit("A timelapse needs frames to be re-encoded, so can't use the 'copy' record backend.")
+        # Whatever stops the loop (even failing to start), the video must be
+        # finalised and the shared memory freed
+        try:
+            cap = self.connect()
+            if cap is None:
+                return
+            # Decode on a separate thread, so that slow analysis never stalls the stream
+            self.reader = FrameReader(cap, size=self.buffer_size, policy=self.drop_policy, metrics=self.metrics)
+            if self.start_stream():
+                self.watch_loop(self.reader)
+        finally:
+            self.cleanup()
+
+    def start_stream(self) -> bool:
+        """
+        Size everything for the stream that's been opened, and start reading it.
+
+        Returns False if it was stopped (while connecting to the main stream).
+        """
+        cap = self.reader.capture
         self.stream_fps = int(cap.get(cv2.CAP_PROP_FPS))
         self.stream_height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
         self.stream_width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
 
-        # The scale is based on the smallest dimension. e.g: 1920x1080 = 10x
-        self.scale = min(self.stream_height, self.stream_width) // 100
+        # In dual-stream mode, the main stream is recorded, and "url" (the
+        # substream) is only analysed
+        self.record_fps, self.record_width, self.record_height = self.stream_fps, self.stream_width, self.stream_height
+        if self.record_url and not self.encoding and not self.image_path:
+            # ffmpeg copies the main stream, so it's never decoded here at all
+            source = probe(self.record_url)
+            self.record_fps, self.record_width, self.record_height = round(source["fps"]), source["width"], source["height"]
+            logging.info(f"Recording from '{self.record_url}' ({self.record_width}x{self.record_height} - {self.record_fps}FPS).")
+        elif self.record_url:
+            main_cap = self.connect(self.record_url)
+            if main_cap is None:
+                return False
+            # Frames are only converted when they might be recorded
+            self.main_reader = FrameReader(
+                main_cap,
+                size=self.buffer_size * 2,
+                metrics=self.metrics,
+                stage="decode_main",
+                retrieve=self.wants_main_frame,
+                # Analysis carries on without the main stream while it reconnects
+                reconnect=(lambda: cv2.VideoCapture(self.record_url)) if self.live else None,
+            )
+            self.record_fps = int(main_cap.get(cv2.CAP_PROP_FPS)) or self.stream_fps
+            self.record_width = int(main_cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+            self.record_height = int(main_cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+            logging.info(f"Recording from '{self.record_url}' ({self.record_width}x{self.record_height} - {self.record_fps}FPS).")
+        # Maps boxes from the analysed stream onto the recorded one
+        self.record_scale = (self.record_width / self.stream_width, self.record_height / self.stream_height)
 
         if not self.output_fps:
-            self.output_fps = self.stream_fps
+            self.output_fps = self.record_fps
 
-        logging.info(f"Streaming from '{self.url}' ({self.stream_width}x{self.stream_height} - {self.stream_fps}FPS).")
-        if self.video_path:
-            logging.info(f"Recording video to '{self.output_video_file}' at {self.speed}x speed ({self.output_fps} -> {self.output_fps * self.speed} FPS).")
+        # Analyse every "xth" frame, to satisfy the analysis FPS limit
+        self.base_stride = 1
+        if self.analysis_fps:
+            self.base_stride = max(-(-self.stream_fps // self.analysis_fps), 1)
+
+        # The current analysis settings (the load controller may lower them)
+        self.analysis_stride = self.base_stride
+        self.controller = None
+        if self.adaptive:
+            self.controller = LoadController(
+                self.stream_fps,
+                temperature_path=self.temperature_path,
+                max_temperature=self.max_temperature,
+                # Debug windows are only drawn without a preview
+                debug=self.debug and not self.preview_port and not self.headless,
+            )
+
+        logging.info(f"Streaming from '{self.url}' ({self.stream_width}x{self.stream_height} - {self.stream_fps}FPS) with {self.capture_backend}.")
+        if self.analysis_stride > 1:
+            logging.info(f"Analysing every {self.analysis_stride} frames ({self.stream_fps / self.analysis_stride:.1f} FPS).")
+        if self.analysis_width or self.pyramid_level:
+            logging.info(f"Analysing motion at reduced resolution (width {self.analysis_width}, pyramid level {self.pyramid_level}).")
+        if self.video_path and not self.encoding:
+            # ffmpeg remuxes the camera's own packets, so nothing is encoded
+            self.stream_recorder = StreamCopyRecorder(
+                self.record_url or self.url,
+                self.video_path,
+                self.prefix,
+                self.video_format,
+                motion=(self.record_mode == RECORD_MOTION),
+                segment_seconds=self.segment_minutes * 60 if self.segment_minutes else None,
+                pre_roll=self.pre_roll,
+                post_roll=self.post_roll,
+            )
+            logging.info(f"Copying the stream to '{self.video_path}' as {self.video_format}, without re-encoding ({self.record_mode}).")
+        elif self.video_path:
+            # Encoding happens on its own thread, with about a second of frames queued
+            self.video_writer = BackgroundVideoWriter(
+                self.video_path,
+                self.prefix,
+                self.codec,
+                self.output_fps * self.speed,
+                (self.record_width, self.record_height),
+                queue_size=max(self.output_fps, 1),
+                rotate_seconds=self.segment_minutes * 60 if self.segment_minutes else None,
+                rotate_bytes=self.segment_mb * 1024 * 1024 if self.segment_mb else None,
+                # A timelapse is a video per day, unless asked otherwise
+                rotate_daily=(self.record_mode == RECORD_TIMELAPSE and not self.segment_minutes),
+            )
+        if self.encoding and self.record_mode == RECORD_MOTION:
+            # Only frames that would be recorded are buffered
+            self.pre_roll_buffer = PreRollBuffer(
+                self.pre_roll * self.output_fps,
+                self.pre_roll_quality,
+                max_bytes=self.pre_roll_mb * 1024 * 1024,
+            )
+            logging.info(f"Recording motion to '{self.video_path}' at {self.speed}x speed ({self.output_fps} -> {self.output_fps * self.speed} FPS), with {self.pre_roll}s pre-roll and {self.post_roll}s post-roll.")
+        elif self.encoding and self.record_mode == RECORD_TIMELAPSE:
+            logging.info(f"Recording a timelapse to '{self.video_path}', with a frame every {self.idle_interval}s when idle, and {self.output_fps} FPS during motion (played at {self.output_fps * self.speed} FPS).")
+        elif self.encoding:
+            logging.info(f"Recording video to '{self.video_path}' at {self.speed}x speed ({self.output_fps} -> {self.output_fps * self.speed} FPS).")
+        if self.segment_minutes or self.segment_mb:
+            logging.info(f"Starting a new video segment every {self.segment_minutes} minutes or {self.segment_mb}MB.")
         if self.image_path:
-            logging.info(f"Recording images to '{self.image_path}'.")
-
-        frame_num = 0
-        old_frames = [None] * max(self.stream_fps // 2, 1)
-        # TODO - is duplex faster or not? Is queue faster?
-        saving_pipe = Pipe()
-        p = Process(target=image_saver.image_saver, args=(saving_pipe,))
-        p.start()
-        saving_pipe[0].close()
-        while (cap.isOpened()):
-            ret, frame = cap.read()
-            frame_num += 1
-
-            if not self.stability_check(cap, ret, frame, frame_num):
-                continue
+            logging.info(f"Recording {self.image_format} images to '{self.image_path}'.")
+        if self.event_db:
+            logging.info(f"Recording motion events to '{self.event_db}'.")
+
+        # Rasterise the region mask once, now that the stream size is known
+        self.region_mask = None
+        if self.mask_config:
+            self.region_mask = RegionMask(self.mask_config, self.stream_width, self.stream_height)
+            logging.info(f"Only analysing the masked region {self.region_mask.box} ({100 * self.region_mask.area / (self.stream_width * self.stream_height):.0f}% of the frame).")
 
-            saving_pipe[1].send(frame)
+        self.analyser = FrameAnalyser(
+            self.create_detector(),
+            self.stream_width,
+            self.stream_height,
+            self.stream_fps,
+            self.region_mask,
+            self.analysis_width,
+            self.pyramid_level,
+            pixels=self.decode_pixels,
+            metrics=self.metrics,
+        )
+        self.tracker = MotionTracker(self.stream_fps)
+        logging.info(f"Detecting motion with the '{self.detector_name}' detector.")
+        # Frames are shared with the saver through shared memory, not pickled.
+        # Without pixels (just motion vectors) or a display, there's nothing to
+        # show, and the preview server replaces the image saver's window.
+        if self.decode_pixels and not self.headless and not self.preview_port:
+            self.saving_ring = SharedFrameRing((self.stream_height, self.stream_width, 3), slots=self.buffer_size)
+            self.saver_process = Process(target=image_saver.image_saver, args=(self.saving_ring,), daemon=True)
+            self.saver_process.start()
 
-            # Check if we're nightvision every few frames
-            if frame_num % self.stream_fps == 0 and self.nightvision != image_utils.is_greyscale(frame):
-                from_string, to_string = ("nightvision", "color") if self.nightvision else ("color", "nightvision")
-                logging.info(f"Changed from {from_string} to {to_string}.")
-                self.nightvision = (not self.nightvision)
+        self.setup_metrics()
+        if self.main_reader is not None:
+            self.main_reader.start()
+        self.reader.start()
+        return True
 
-            # Keep track of the last several frames
-            # FIXME - maybe don't blur nightvision images? The greys REALLY blend together
-            new_simple = image_utils.simplify_image(frame.copy(), greyscale=True, blur=True)
-            old_frames.insert(0, new_simple)
+    def stop(self) -> None:
+        """
+        Finish the current frame, then clean up and return. Safe to call
+        from a signal handler or another thread.
+        """
+        self.stop_event.set()
 
-            # Detect motion (compare to several frames ago)
-            old_frame = old_frames.pop()
-            motion_area = image_utils.detect_motion(old_frame, new_simple, self.scale, self.nightvision)
+    def watch_loop(self, reader: FrameReader) -> None:
+        while not self.stop_event.is_set():
+            if not reader.isOpened():
+                if not self.live or not self.reconnect():
+                    break
 
-            self.handle_motion(motion_area)
+            with self.metrics.stage("wait"):
+                captured = reader.read()
+            frame, frame_num = captured.frame, captured.index
+            busy_start = time.perf_counter()
 
-            # Write frame to video and/or image
-            self.save_video(frame, frame_num)
-            self.save_image(frame, frame_num)
+            if not self.stability_check(reader, captured):
+                continue
 
-            if self.debug:
-                debug_frame = frame.copy()
+            if self.saving_ring is not None:
+                with self.metrics.stage("share"):
+                    self.saving_ring.send(frame)
 
-                # Print the biggest movement detected
-                (x, y, w, h) = motion_area
-                cv2.rectangle(debug_frame, (x, y), (x + w, y + h), (0, 0, 255), 2)
+            # Skipped (and dropped) frames are still recorded, just not analysed
+            if frame_num - self.last_analysed >= self.analysis_stride:
+                self.motion_area = self.analyser.analyse(frame, captured.side_data)
+                self.handle_motion(self.motion_area, frame_num - self.last_analysed)
+                self.last_analysed = frame_num
 
-                cv2.putText(debug_frame, datetime.now().strftime("%d/%m/%Y %H:%M:%S"), (1, 15), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 2)
-                cv2.putText(debug_frame, "Motion: " + str(self.recent_motion), (1, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 2)
+            # Write frame to video and/or image
+            if self.main_reader is not None:
+                self.record_main_stream(captured.timestamp)
+            else:
+                with self.metrics.stage("video"):
+                    self.save_video(frame, frame_num)
+                with self.metrics.stage("image"):
+                    self.save_image(frame, frame_num)
 
+            if self.preview is not None and self.preview.wants_frame():
+                # Only shrunk, drawn on and encoded while someone is watching
+                with self.metrics.stage("preview"):
+                    preview_frame = self.preview.shrink(frame)
+                    self.draw_overlay(preview_frame, self.preview.scale)
+                    self.preview.publish(preview_frame)
+            elif self.debug and self.preview is None and not self.headless and (self.controller is None or self.controller.debug):
+                debug_start = time.perf_counter()
+                # The frame is still queued for encoding, so draw on a reused copy
+                debug_frame = self.analyser.workspace.buffer("debug", frame.shape)
+                debug_frame[:] = frame
+                self.draw_overlay(debug_frame)
                 image_utils.show_image(debug_frame, "Debug Visualisation")
+                self.shown_windows = True
+                self.metrics.observe("debug", time.perf_counter() - debug_start)
+
+            busy_seconds = time.perf_counter() - busy_start
+            self.metrics.observe("frame", busy_seconds)
+            if self.controller is not None:
+                self.controller.record(busy_seconds)
+                if self.controller.update(reader.frames_dropped):
+                    self.apply_load_level()
+
+            if time.monotonic() - self.last_metrics >= self.metrics_interval:
+                self.last_metrics = time.monotonic()
+                logging.info(self.metrics.summary())
+
+            if self.stats_callback is not None and time.monotonic() - self.last_stats >= self.stats_interval:
+                self.last_stats = time.monotonic()
+                self.stats_callback(self.stats())
 
             if self.finish_time is not None and datetime.now() > self.finish_time:
                 logging.info("Duration is up. Exiting.")
                 break
 
-        self.cleanup(cap, p)
+    def wants_main_frame(self, index: int) -> bool:
+        """
+        Whether the main stream's frame should be converted and queued (from
+        the main stream's reader thread). Otherwise it's only grabbed.
+
+        Frames are wanted when they'd be recorded, or kept for the pre-roll.
+        """
+        if not self.encoding and not self.image_path:
+            return False
+        selected = (index * self.output_fps) % self.record_fps < self.output_fps
+        if self.record_mode == RECORD_CONTINUOUS or self.recent_motion > 0 or self.post_roll_remaining > 0:
+            return selected
+        if self.record_mode == RECORD_MOTION:
+            return selected and self.pre_roll > 0
+        # Timelapse, when idle
+        return self.last_idle_frame is None or index - self.last_idle_frame >= self.record_fps * self.idle_interval
+
+    def record_main_stream(self, timestamp: float) -> None:
+        """
+        Record the main stream's frames, up to the time of the analysed frame
+        (plus "record_offset", if the main stream arrives later).
+        """
+        for main in self.main_reader.read_until(timestamp + self.record_offset):
+            if not main.ok:
+                continue
+            with self.metrics.stage("video"):
+                self.save_video(main.frame, main.index)
+            with self.metrics.stage("image"):
+                self.save_image(main.frame, main.index)
+
+    def record_box(self, box: tuple) -> tuple:
+        """
+        Map a box from the analysed stream onto the recorded stream.
+        """
+        if self.record_scale == (1, 1):
+            return box
+        x_scale, y_scale = self.record_scale
+        x, y, w, h = box
+        return (round(x * x_scale), round(y * y_scale), round(w * x_scale), round(h * y_scale))
+
+    def draw_overlay(self, image, scale: float = 1) -> None:
+        """
+        Draw the debug overlay (the motion, the mask, the time) on an image,
+        which may have been shrunk by "scale".
+        """
+        # Show the region that's being analysed
+        if self.region_mask is not None:
+            outlines = self.region_mask.outlines
+            if scale != 1:
+                outlines = [(outline * scale).astype(outline.dtype) for outline in outlines]
+            cv2.drawContours(image, outlines, -1, (255, 0, 0), 1)
+
+        # Print the biggest movement detected
+        (x, y, w, h) = image_utils.scale_box(self.motion_area, scale)
+        cv2.rectangle(image, (x, y), (x + w, y + h), (0, 0, 255), 2)
+
+        cv2.putText(image, datetime.now().strftime("%d/%m/%Y %H:%M:%S"), (1, 15), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 2)
+        cv2.putText(image, "Motion: " + str(self.recent_motion), (1, 30), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 2)
+
+    def setup_metrics(self) -> None:
+        """
+        Register the counters and gauges, and serve them if asked to.
+        """
+        reader = self.reader
+        self.metrics.counter("frames_read", lambda: reader.frames_read)
+        self.metrics.counter("frames_dropped", lambda: reader.frames_dropped)
+        self.metrics.counter("frames_analysed", lambda: self.frames_analysed)
+        self.metrics.counter("motion_events", lambda: self.motion_events)
+        self.metrics.counter("stability_drops", lambda: self.stability_drops)
+        self.metrics.counter("reconnects", lambda: self.reconnects)
+        self.metrics.counter("disconnected_seconds", self.total_disconnected_seconds)
+        self.metrics.gauge("connected", lambda: int(self.connected))
+        self.metrics.gauge("queue_depth", lambda: reader.depth)
+        if self.main_reader is not None:
+            self.metrics.counter("main_frames_read", lambda: self.main_reader.frames_read)
+            self.metrics.counter("main_frames_skipped", lambda: self.main_reader.frames_skipped)
+            self.metrics.counter("main_frames_dropped", lambda: self.main_reader.frames_dropped)
+            self.metrics.counter("main_reconnects", lambda: self.main_reader.reconnects)
+        self.metrics.gauge("recent_motion", lambda: self.recent_motion)
+        self.metrics.gauge("analysis_stride", lambda: self.analysis_stride)
+        if self.video_writer is not None:
+            self.metrics.counter("frames_written", lambda: self.video_writer.frames_written)
+            self.metrics.counter("video_frames_dropped", lambda: self.video_writer.frames_dropped)
+            self.metrics.gauge("video_queue_depth", lambda: self.video_writer.depth)
+        if self.snapshot_writer is not None:
+            self.metrics.counter("images_written", lambda: self.snapshot_writer.saved)
+            self.metrics.counter("images_dropped", lambda: self.snapshot_writer.dropped)
+            self.metrics.counter("images_deduplicated", lambda: self.snapshot_writer.duplicates)
+
+        if self.metrics_port:
+            self.metrics_server = MetricsServer(self.metrics, self.metrics_port)
+
+        if self.preview_port:
+            self.preview = PreviewServer(self.preview_port, self.preview_host, width=self.preview_width, fps=self.preview_fps)
+            self.metrics.gauge("preview_viewers", lambda: self.preview.viewers)
+            self.metrics.counter("preview_frames_encoded", lambda: self.preview.frames_encoded)
+
+    def apply_load_level(self) -> None:
+        """
+        Change the analysis settings to match the load controller's level.
+        """
+        divisor = self.controller.width_divisor
+        old_stride = self.analysis_stride
+        self.analysis_stride = self.base_stride * self.controller.stride
+        if self.pyramid_level:
+            self.analyser.pyramid_level = self.pyramid_level + divisor.bit_length() - 1
+        elif divisor > 1:
+            self.analyser.width = (self.analysis_width or self.stream_width) // divisor
+        else:
+            self.analyser.width = self.analysis_width
+
+        # The detector keeps its history (and resizes it, if the width
+        # changed), so motion that's in progress isn't cut short
+        if self.analysis_stride != old_stride and self.detector_name != VECTOR_DETECTOR:
+            self.analyser.detector.set_fps(self.stream_fps // self.analysis_stride)
+
+    def create_detector(self):
+        if self.detector_name == VECTOR_DETECTOR:
+            mask = self.region_mask.mask if self.region_mask is not None else None
+            return MotionVectorDetector(self.stream_width, self.stream_height, mask=mask)
+        detector = image_utils.create_motion_detector(self.detector_name, self.stream_fps // self.analysis_stride)
+        # Background subtractors can't be split, so they ignore this
+        detector.bands = self.band_pool
+        return detector
 
-    def cleanup(self, cap: cv2.VideoCapture, p) -> None:
+    def stats(self) -> dict:
+        """
+        A summary of how the stream is going, e.g: for a supervisor to report.
+        """
+        return {
+            "url": self.url,
+            "uptime": round((datetime.now() - self.start_time).total_seconds()),
+            "stream_fps": self.stream_fps,
+            "analysis_stride": self.analysis_stride,
+            "load_level": self.controller.level if self.controller else 0,
+            "frames_read": self.reader.frames_read,
+            "frames_dropped": self.reader.frames_dropped,
+            "frames_analysed": self.frames_analysed,
+            "queue_depth": self.reader.depth,
+            "stability": self.stability,
+            "reconnects": self.reconnects,
+            "disconnected_seconds": round(self.total_disconnected_seconds()),
+            "recent_motion": self.recent_motion,
+            "nightvision": self.nightvision,
+            "video_writer": self.video_writer.stats() if self.video_writer else None,
+            "stream_recorder": self.stream_recorder.stats() if self.stream_recorder else None,
+            "snapshot_writer": self.snapshot_writer.stats() if self.snapshot_writer else None,
+        }
+
+    def cleanup(self) -> None:
         logging.info("Cleaning up")
+        logging.info(self.metrics.summary())
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+        if self.main_reader is not None:
+            self.main_reader.stop()
+            self.main_reader.capture.release()
+            logging.info(f"Read {self.main_reader.frames_read} frames from the main stream, and only converted {self.main_reader.frames_read - self.main_reader.frames_skipped}.")
+        if self.band_pool is not None:
+            self.band_pool.close()
+        if self.preview is not None:
+            self.preview.close()
+            logging.info(f"Preview stats: {self.preview.stats()}.")
+        reader = self.reader
+        if reader is not None:
+            logging.info(f"Read {reader.frames_read} frames, dropped {reader.frames_dropped} (max queue depth {reader.max_depth}/{reader.size}).")
+            reader.stop()
+        self.finish_event()
         if self.video_writer is not None:
             self.video_writer.release()
-        cap.release()
-        cv2.destroyAllWindows()
-        p.join()
+            logging.info(f"Video writer stats: {self.video_writer.stats()}.")
+        if self.stream_recorder is not None:
+            self.stream_recorder.release()
+            logging.info(f"Stream recorder stats: {self.stream_recorder.stats()}.")
+        if self.event_index is not None:
+            self.event_index.close()
+            logging.info(f"Wrote {self.event_index.events_written} motion events to '{self.event_db}'.")
+        if self.snapshot_writer is not None:
+            self.snapshot_writer.close()
+            logging.info(f"Image writer stats: {self.snapshot_writer.stats()}.")
+            if self.image_dedupe is not None:
+                logging.info(f"Skipped {self.snapshot_writer.duplicates} duplicate images, saving about {self.snapshot_writer.bytes_avoided() / 1024 / 1024:.1f}MB.")
+        if reader is not None:
+            reader.capture.release()
+        if self.shown_windows:
+            # Headless builds of OpenCV (and the preview) have no windows to destroy
+            cv2.destroyAllWindows()
+        if self.saving_ring is not None:
+            logging.info(f"Shared {self.saving_ring.sent} frames with the image saver, dropped {self.saving_ring.dropped}.")
+            self.saving_ring.close()
+            if self.saver_process is not None:
+                self.saver_process.join()
+            self.saving_ring.unlink()
+
+    def connect(self, url: str = None, wait: bool = False):
+        """
+        Open the stream (or "url"), retrying until it's open and has a size.
+        Cameras are often unreachable for a while (e.g: at startup, or after
+        a power cut), so it waits longer (with some jitter) after each failed
+        attempt. Files aren't retried.
+
+        Returns None if it was stopped, or the duration ran out, first.
+        """
+        backoff = Backoff()
+        while True:
+            if self.finish_time is not None and datetime.now() > self.finish_time:
+                logging.info("Duration is up. Giving up on connecting.")
+                return None
+
+            # Jitter stops several cameras on the same network retrying in lockstep
+            if wait and self.stop_event.wait(backoff.next()):
+                logging.info("Stopped while connecting.")
+                return None
+            wait = True
+
+            cap = None
+            try:
+                cap = cv2.VideoCapture(url) if url else self.open_capture()
+                # An unopened capture reports a size of 0x0 (or -1x-1)
+                if cap.isOpened() and min(capture_size(cap)) > 0:
+                    return cap
+                error = "it isn't open"
+            except Exception as e:
+                error = e
+            if cap is not None:
+                cap.release()
+            if not self.live:
+                raise SystemExit(f"Failed to open '{url or self.url}': {error}.")
+            logging.warning(f"Failed to connect to '{url or self.url}' ({error}). Retrying.")
+
+    def reconnect(self) -> bool:
+        """
+        Reopen the stream in place, waiting longer (with some jitter) after
+        each failed attempt. The image saver, video writer and detector are
+        kept as they are, so they carry on as soon as frames arrive again.
+
+        Returns False if the duration ran out before it could reconnect.
+        """
+        if self.finish_time is not None and datetime.now() > self.finish_time:
+            return False
+
+        logging.warning("Lost the stream. Reconnecting.")
+        self.connected = False
+        self.disconnected_at = time.monotonic()
+        self.reader.stop()
+        self.reader.capture.release()
+
+        cap = self.connect(wait=True)
+        if cap is None:
+            return False
+
+        size = capture_size(cap)
+        if size != (self.stream_width, self.stream_height):
+            # Everything downstream is sized for the old stream (watch() cleans up)
+            cap.release()
+            raise SystemExit(f"The stream changed size from {self.stream_width}x{self.stream_height} to {size[0]}x{size[1]}. Exiting.")
+
+        self.disconnected_seconds = self.total_disconnected_seconds()
+        self.connected = True
+        self.reconnects += 1
+        self.stability = MAX_STABILITY
+        self.reader.reopen(cap)
+        logging.info(f"Reconnected to the stream, after {time.monotonic() - self.disconnected_at:.0f}s.")
+        return True
+
+    def total_disconnected_seconds(self) -> float:
+        if self.connected:
+            return self.disconnected_seconds
+        return self.disconnected_seconds + time.monotonic() - self.disconnected_at
 
-    def stability_check(self, cap, ret, frame, frame_num):
+    def stability_check(self, reader, captured):
         # Error handling + Stability monitoring
+        frame = captured.frame
         if self.stability <= 0:
-            # If stability is too low, give up and exit
-            logging.fatal("Connection is too unstable. Exiting.")
-            self.cleanup(cap)
-            raise SystemExit("Connection is too unstable. Exiting.")
-        if not ret:
+            # If stability is too low, reconnect (or finish, if that fails)
+            logging.error("Connection is too unstable.")
+            if not self.live or not self.reconnect():
+                reader.stop()
+            return False
+        if not captured.ok:
             logging.warning("Failed to read frame from stream.")
             self.stability -= 1
+            self.stability_drops += 1
             return False
         elif frame is None or frame.size == 0:
             logging.warning("Bad/blank frame.")
             self.stability -= 1
+            self.stability_drops += 1
             return False
         elif self.stability < MAX_STABILITY:
             # Successfully processing a frame restores lost stability
             self.stability = min(self.stability + 1, MAX_STABILITY)
 
         # Lag detection (CPU-bottlenecked devices)
-        stream_frame_num = cap.get(cv2.CAP_PROP_POS_FRAMES)
-        if frame_num != stream_frame_num:
-            logging.warning(f"LAGGING BEHIND FEED! THIS IS BAD!!! {frame_num} vs {stream_frame_num}.")
-            stream_ms = round(cap.get(cv2.CAP_PROP_POS_MSEC), 2)
-            logging.warning(f"The stream is apparently {stream_ms}ms in.")
-            # TODO - Actually do something about this? Reduce FPS?
-            return False
+        # The reader drops frames when we can't keep up, so just report it
+        if reader.frames_dropped != self.reported_drops and captured.timestamp - self.last_drop_report >= 1:
+            logging.warning(f"Lagging behind feed. Dropped {reader.frames_dropped - self.reported_drops} frames ({reader.frames_dropped} total, queue depth {reader.depth}/{reader.size}).")
+            self.reported_drops = reader.frames_dropped
+            self.last_drop_report = captured.timestamp
         return True
 
-    def handle_motion(self, motion_area):
+    def handle_motion(self, motion_area, frames: int = 1):
+        """
+        Start and finish motion events, as the tracker sees motion start and
+        stop. See `MotionTracker`.
+
+        If only every few frames are analysed, "frames" is how many frames
+        this motion_area stands for.
         """
-        recent_motion is a measure of how much motion there has been over
-        the past few seconds. This value has a maximum value that it caps at.
+        change = self.tracker.update(motion_area, frames)
+        if change == MOTION_STOPPED:
+            logging.info("Motion has stopped")
+            self.finish_event()
+            if self.stream_recorder is not None:
+                self.stream_recorder.stop_motion()
+        elif change == MOTION_STARTED:
+            logging.info("New motion detected")
+            self.motion_events += 1
+            self.start_event(motion_area)
+            if self.stream_recorder is not None:
+                self.stream_recorder.start_motion()
+        elif change == MOTION_CONTINUING and self.event is not None:
+            self.event.update(self.record_box(motion_area))
+
+    def start_event(self, motion_area) -> None:
+        if self.event_index is None:
+            return
+
+        video_fps = None
+        if self.video_writer is not None:
+            video_fps = self.output_fps * self.speed
+        elif self.stream_recorder is not None:
+            # Copied video keeps the stream's own frame rate
+            video_fps = self.record_fps
+        # Boxes are recorded in the recording's coordinates
+        self.event = MotionEvent(self.camera, self.record_box(motion_area), video_fps)
+        if video_fps is not None:
+            self.mark_recording(self.event.set_start)
 
-        If this value is already 0, then there has been no recent motion.
+    def finish_event(self) -> None:
+        if self.event is None:
+            return
 
-        As soon as this value drops down from 1 to 0, a segment of recent motion
-        is said to have stopped.
+        event, self.event = self.event, None
+        event.end_time = time.time()
+        if event.video_fps is None:
+            self.event_index.record(event)
+            return
 
-        TODO - Add a "threshold" here. A single frame of tiny movement should
-        not count as movement. Movement should be based on size as well.
-        A single frame of major movement might be enough to trigger the start
-        of movement, or several frames of small movement.
-        Consider categorising movement (small, medium, large)?
+        def recorded(filename, frame_offset):
+            event.set_end(filename, frame_offset)
+            self.event_index.record(event)
+        self.mark_recording(recorded, before_next=False)
+
+    def mark_recording(self, callback, before_next: bool = True) -> None:
         """
-        if not motion_area or motion_area == (0, 0, 0, 0):
-            # No motion detected
-            if self.recent_motion == 1:
-                logging.info("Motion has stopped")
-            self.recent_motion = max(0, self.recent_motion - 1)
-        elif self.recent_motion == 0:
-            # New motion detected
-            logging.info("New motion detected")
-            self.recent_motion = self.stream_fps * MAX_MOTION_SECONDS
-        else:
-            # Motion is continuing
-            self.recent_motion = min(self.recent_motion + MAX_MOTION_SECONDS, self.stream_fps * MAX_MOTION_SECONDS)
+        Find out where the current frame ends up in the recordings, as
+        "callback(filename, frame_offset)", once it's been written.
+        See `BackgroundVideoWriter.mark` and `StreamCopyRecorder.mark`.
+        """
+        if self.video_writer is not None:
+            # Frames are encoded later, so the writer works out where they went
+            self.video_writer.mark(callback, before_next)
+            return
+
+        fps = self.record_fps
+
+        def copied(filename, seconds):
+            callback(filename, None if seconds is None else round(seconds * fps))
+        self.stream_recorder.mark(copied)
 
     def save_video(self, frame, frame_num):
-        if not self.video_path:
+        if not self.encoding:
             return
 
-        # Create a new file to save the video to
-        if self.video_writer is None:
-            logging.debug("Initialising video file.")
-            pathlib.Path(self.video_path).mkdir(parents=True, exist_ok=True)
-            self.video_writer = cv2.VideoWriter(
-                self.output_video_file,
-                self.codec,
-                self.output_fps * self.speed,
-                (self.stream_width, self.stream_height),
-            )
+        if self.record_mode == RECORD_TIMELAPSE and self.recent_motion == 0:
+            # Idle periods are decimated much more heavily
+            if not self.timelapse_gate(frame_num):
+                return
+        elif (frame_num * self.output_fps) % self.record_fps >= self.output_fps:
+            # Record every "xth" frame, to satisfy the FPS limit. This is the same
+            # as "frame_num % (stream_fps / output_fps) < 1", without the division.
+            return
+
+        if self.record_mode == RECORD_MOTION and not self.motion_gate(frame):
+            return
 
-        # Record every "xth" frame, to satisfy the FPS limit.
-        if frame_num % (Decimal(self.stream_fps) / Decimal(self.output_fps)) < 1:
-            logging.debug(f"Recording frame #{frame_num} to video.")
-            self.video_writer.write(frame)
+        logging.debug(f"Recording frame #{frame_num} to video.")
+        if not self.video_writer.write(frame):
+            logging.warning(f"Video encoder is falling behind. Dropped frame #{frame_num}.")
+
+    def timelapse_gate(self, frame_num) -> bool:
+        """
+        Decide whether to record an idle frame, when recording a timelapse.
+
+        During motion, frames are kept at the output FPS (like continuous
+        recording). Otherwise, only one frame is kept every "idle_interval"
+        seconds, so a quiet day shrinks to a few seconds of video.
+        """
+        # Counted in frames (including dropped ones), so it's all integers
+        if self.last_idle_frame is not None and frame_num - self.last_idle_frame < self.record_fps * self.idle_interval:
+            return False
+        self.last_idle_frame = frame_num
+        return True
+
+    def motion_gate(self, frame) -> bool:
+        """
+        Decide whether to record this frame, when only recording motion.
+
+        Each motion event gets its own file. It begins with the pre-roll (the
+        frames from just before the motion), and continues for the post-roll
+        after `recent_motion` has dropped back to 0.
+        """
+        if self.recent_motion > 0:
+            self.post_roll_remaining = self.post_roll * self.output_fps
+        elif self.post_roll_remaining > 0:
+            self.post_roll_remaining -= 1
+        else:
+            if self.recording:
+                self.recording = False
+                self.video_writer.split()
+            self.pre_roll_buffer.append(frame)
+            return False
+
+        if not self.recording:
+            self.recording = True
+            logging.debug(f"Writing {len(self.pre_roll_buffer)} frames of pre-roll.")
+            # The whole pre-roll is one item in the queue, and it's decoded on
+            # the encoder's thread, so analysis never waits for it
+            self.video_writer.write_all(self.pre_roll_buffer.take())
+        return True
 
     def save_image(self, frame, frame_num):
         if not self.image_path:
             return
 
         logging.debug(f"Saving frame #{frame_num} as image.")
-        cv2.imwrite(self.image_path + f"{frame_num}.jpg", frame)
+        if not self.snapshot_writer.save(frame, str(frame_num), motion=self.recent_motion > 0):
+            logging.warning(f"Image writer is falling behind. Dropped frame #{frame_num}.")
 
 
 if __name__ == "__main__":
@@ -262,11 +969,100 @@ if __name__ == "__main__":
         help="The path to save videos to. No video is saved without this.")
     parser.add_argument("--image-path", "-i", type=str,
         help="The path to save images to. No images are saved without this.")
+    parser.add_argument("--image-quality", type=int,
+        help="The quality (1-100) to save jpg/webp images at. Defaults to 90.")
+    parser.add_argument("--image-format", type=str, choices=IMAGE_FORMATS,
+        help="The format to save images in. Defaults to jpg.")
+    parser.add_argument("--image-dedupe", type=int, nargs="?", const=4,
+        help="Only save images that differ from the last one saved by more than this many bits of their perceptual hash (out of 64), or that have motion. Defaults to 4.")
+    parser.add_argument("--image-keepalive", type=int,
+        help="With --image-dedupe, still save an image every this many minutes. Defaults to 5.")
     parser.add_argument("--debug", "-x", action='store_true',
         help="Enable debugging,")
+    parser.add_argument("--headless", action='store_true',
+        help="Don't show any windows (e.g: without a display).")
+    parser.add_argument("--preview-port", type=int,
+        help="Serve a live preview (with the debug overlay) at http://<host>:<port>/, instead of showing windows.")
+    parser.add_argument("--preview-host",
+        help="The address to serve the preview on. Defaults to 127.0.0.1 (this machine only). Use 0.0.0.0 to allow any machine to watch.")
+    parser.add_argument("--preview-width", type=int,
+        help="The width to shrink preview frames to. Defaults to 640.")
+    parser.add_argument("--preview-fps", type=int,
+        help="The max FPS of the preview. Defaults to 5.")
+    parser.add_argument("--buffer-size", "-b", type=int,
+        help="The number of decoded frames to buffer while analysis catches up. Defaults to 4.")
+    parser.add_argument("--analysis-width", "-a", type=int,
+        help="Shrink frames to this width before detecting motion. Defaults to the stream width.")
+    parser.add_argument("--pyramid-level", type=int,
+        help="Halve frames this many times before detecting motion. Overrides --analysis-width.")
+    parser.add_argument("--detector", "-m", type=str, choices=DETECTORS,
+        help="The motion detection engine. 'vectors' uses the stream's H.264 motion vectors (needs PyAV). Defaults to framediff.")
+    parser.add_argument("--detect-bands", type=int,
+        help="Split motion detection into this many horizontal bands, on separate threads. For high resolutions on multi-core boards.")
+    parser.add_argument("--record-mode", "-r", type=str, choices=RECORD_MODES,
+        help="Record video continuously, only when there is motion, or as a timelapse that speeds through idle periods. Defaults to continuous.")
+    parser.add_argument("--idle-interval", type=int,
+        help="In timelapse mode, keep a frame every this many seconds when there's no motion. Defaults to 60.")
+    parser.add_argument("--pre-roll", type=int,
+        help="Seconds of video to keep from before motion starts. Defaults to 5.")
+    parser.add_argument("--post-roll", type=int,
+        help="Seconds of video to keep recording after motion stops. Defaults to 5.")
+    parser.add_argument("--pre-roll-quality", type=int,
+        help="JPEG compress the pre-roll at this quality (1-100), to save RAM.")
+    parser.add_argument("--pre-roll-mb", type=int,
+        help="The most RAM an uncompressed pre-roll may use. Beyond this, it's JPEG compressed anyway. Defaults to 128.")
+    parser.add_argument("--analysis-fps", type=int,
+        help="The max FPS to analyse. Every frame is still recorded. Defaults to the stream FPS.")
+    parser.add_argument("--adaptive", action='store_true',
+        help="Analyse fewer/smaller frames (and skip debug rendering) when the CPU can't keep up.")
+    parser.add_argument("--temperature-path", type=str, nargs="?", const=DEFAULT_TEMPERATURE_PATH,
+        help=f"Also back off when the CPU temperature (from sysfs) is too hot. Defaults to {DEFAULT_TEMPERATURE_PATH}.")
+    parser.add_argument("--max-temperature", type=float,
+        help="The CPU temperature to back off at, with --temperature-path. Defaults to 75.")
+    parser.add_argument("--segment-minutes", type=int,
+        help="Start a new video file every this many minutes.")
+    parser.add_argument("--segment-mb", type=int,
+        help="Start a new video file once it reaches this many MB.")
+    parser.add_argument("--metrics-port", type=int,
+        help="Serve Prometheus metrics at http://127.0.0.1:<port>/metrics.")
+    parser.add_argument("--metrics-interval", type=int,
+        help="Log a summary of the metrics every this many seconds. Defaults to 60.")
+    parser.add_argument("--record-backend", type=str, choices=RECORD_BACKENDS,
+        help="Re-encode decoded frames with OpenCV, or 'copy' the camera's stream with ffmpeg (no re-encoding). Defaults to opencv.")
+    parser.add_argument("--video-format", type=str, choices=VIDEO_FORMATS,
+        help="The container to copy the stream into, with --record-backend copy. Defaults to mkv.")
+    parser.add_argument("--record-url", type=str,
+        help="Record this (main) stream, and only analyse --url (e.g: the camera's low-res substream).")
+    parser.add_argument("--record-offset", type=float,
+        help="How many seconds later the --record-url stream arrives than --url. Defaults to 0.")
+    parser.add_argument("--capture-backend", "-c", type=str, choices=CAPTURE_BACKENDS,
+        help="Decode with OpenCV, or with a local ffmpeg process. Defaults to opencv.")
+    parser.add_argument("--decode-width", type=int,
+        help="With ffmpeg, scale frames down to this width while decoding.")
+    parser.add_argument("--decode-fps", type=int,
+        help="With ffmpeg, change the frame rate while decoding.")
+    parser.add_argument("--keyframes-only", action='store_true',
+        help="With ffmpeg, only decode keyframes. Very cheap, but only about 1 FPS.")
+    parser.add_argument("--drop-policy", type=str, choices=DROP_POLICIES,
+        help="Which frames to drop when the buffer is full. Defaults to drop-oldest for streams, and block for files.")
+    parser.add_argument("--event-db", type=str,
+        help="Record each motion event in this SQLite database. See events.py.")
+    parser.add_argument("--mask", type=str,
+        help="A JSON file of polygons to include/exclude from motion detection. See region_mask.py.")
 
     args = parser.parse_args()
 
+    simple_logging("streamwatch", level=logging.DEBUG, stdout=True)
+
+    # Finish the current frame and clean up, rather than dying mid-write
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda *args: stopping.set())
+
+    mask = None
+    if args.mask:
+        with open(args.mask, "r") as f:
+            mask = json.loads(f.read())
+
     StreamWatch(
         url=args.url,
         fps=args.fps,
@@ -276,4 +1072,44 @@ if __name__ == "__main__":
         video_path=args.video_path,
         image_path=args.image_path,
         debug=args.debug,
+        buffer_size=args.buffer_size,
+        drop_policy=args.drop_policy,
+        analysis_width=args.analysis_width,
+        pyramid_level=args.pyramid_level,
+        detector=args.detector,
+        record_mode=args.record_mode,
+        pre_roll=args.pre_roll,
+        post_roll=args.post_roll,
+        pre_roll_quality=args.pre_roll_quality,
+        pre_roll_mb=args.pre_roll_mb,
+        analysis_fps=args.analysis_fps,
+        adaptive=args.adaptive,
+        temperature_path=args.temperature_path,
+        max_temperature=args.max_temperature,
+        segment_minutes=args.segment_minutes,
+        segment_mb=args.segment_mb,
+        image_quality=args.image_quality,
+        image_format=args.image_format,
+        metrics_port=args.metrics_port,
+        metrics_interval=args.metrics_interval,
+        capture_backend=args.capture_backend,
+        decode_width=args.decode_width,
+        decode_fps=args.decode_fps,
+        keyframes_only=args.keyframes_only,
+        mask=mask,
+        event_db=args.event_db,
+        idle_interval=args.idle_interval,
+        preview_port=args.preview_port,
+        preview_host=args.preview_host,
+        preview_width=args.preview_width,
+        preview_fps=args.preview_fps,
+        record_url=args.record_url,
+        record_offset=args.record_offset,
+        record_backend=args.record_backend,
+        video_format=args.video_format,
+        detect_bands=args.detect_bands,
+        image_dedupe=args.image_dedupe,
+        image_keepalive=args.image_keepalive,
+        stop_event=stopping,
+        headless=args.headless,
     )